@@ -0,0 +1,94 @@
+#!/usr/local/bin/python
+"""
+
+Differential check of the Mornington Crescent backends and optimizer
+Usage: python benchmarks/differential.py
+
+Runs the bundled examples on several inputs with the interpreter, the
+compiled backend and both of them optimized, and checks that they agree
+on the output, the station values and the accumulator, and that the steps
+executed plus the steps the optimizer saved are the same. Exits with 1
+on any mismatch, so it can be run after every change to the backends.
+
+"""
+
+import glob
+import io
+import os
+import signal
+import sys
+
+path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, path)
+
+from esoterpret.interpreter.output import CaptureSink
+from esoterpret.language import Language
+
+# Inputs every bundled example is run on
+inputs = {
+    "calculator.mcresc": ["1234*5678", "8+5", "100-250", "99/7", "0*0"],
+    "hello-world.mcresc": [""],
+    "prime-number-test.mcresc": ["1", "2", "9", "97", "7917", "7919"],
+}
+
+# Seconds a single run may take, a variant looping forever is a mismatch
+timeout = 30
+
+class TimedOut(Exception):
+    pass
+
+def _time_out(signal_number, frame):
+    raise TimedOut("no result after %d seconds" % timeout)
+
+# Interpreter options of the variants compared, the first is the reference
+variants = [
+    {"backend": "interpreter"},
+    {"backend": "compiled"},
+    {"backend": "interpreter", "optimize": True},
+    {"backend": "compiled", "optimize": True},
+]
+
+def outcome(interpreter_class, code, stdin, options):
+    """Run a program, describing how it ended as a dict"""
+    sink = CaptureSink()
+    interpreter = interpreter_class(code, io.StringIO(stdin), sink=sink, **options)
+    # Step and time limits would make the compiled backend fall back to
+    # the interpreter, an alarm stops a run that doesn't end instead
+    signal.alarm(timeout)
+    try:
+        steps = interpreter.run()
+    except Exception as error:
+        return {"error": "%s: %s" % (type(error).__name__, error), "stdout": sink.getvalue()}
+    finally:
+        signal.alarm(0)
+    return {"stdout": sink.getvalue(),
+            "steps": steps + interpreter.steps_saved,
+            "accumulator": interpreter.accumulator,
+            "station_values": interpreter.station_values}
+
+def compare(reference, other):
+    """Names of the fields in which two outcomes differ"""
+    return sorted(key for key in set(reference) | set(other) if reference.get(key) != other.get(key))
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGALRM, _time_out)
+    interpreter_class = Language("morningtoncrescent").interpreter_class
+    examples = os.path.join(path, "modules", "morningtoncrescent", "examples")
+    runs = mismatches = 0
+    for filename in sorted(glob.glob(os.path.join(examples, "*.mcresc"))):
+        with open(filename) as script:
+            code = script.read()
+        name = os.path.basename(filename)
+        for stdin in inputs.get(name, [""]):
+            reference = outcome(interpreter_class, code, stdin, variants[0])
+            for options in variants[1:]:
+                runs += 1
+                different = compare(reference, outcome(interpreter_class, code, stdin, options))
+                if different:
+                    mismatches += 1
+                    print("%s with input %r, %s: %s differ" % (
+                        name, stdin, ", ".join("%s=%s" % item for item in sorted(options.items())),
+                        ", ".join(different)))
+    print("%d mismatches in %d runs" % (mismatches, runs))
+    if mismatches:
+        sys.exit(1)
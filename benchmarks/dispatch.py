@@ -0,0 +1,63 @@
+#!/usr/local/bin/python
+"""
+
+Micro-benchmark for the Mornington Crescent station dispatch
+Usage: python benchmarks/dispatch.py [--repeat N] [--backend NAME] [--optimize]
+
+Runs the bundled examples and reports steps per second.
+
+"""
+
+import argparse
+import glob
+import io
+import os
+import sys
+import time
+
+path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, path)
+
+from esoterpret.interpreter.output import CaptureSink
+from esoterpret.language import Language
+
+# stdin used for each bundled example, chosen to give a long enough run
+inputs = {
+    "calculator.mcresc": "1234*5678",
+    "hello-world.mcresc": "",
+    "prime-number-test.mcresc": "7919",
+}
+
+def measure(interpreter_class, code, stdin, **options):
+    """Run a program to completion, returning (steps, seconds)"""
+    interpreter = interpreter_class(code, io.StringIO(stdin), sink=CaptureSink(), **options)
+    start = time.perf_counter()
+    steps = interpreter.run()
+    return steps, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    Measure Mornington Crescent steps per second on the bundled examples""")
+    parser.add_argument("-r", "--repeat",
+                        help="runs per example, the fastest one is reported",
+                        type=int,
+                        default=5)
+    parser.add_argument("-b", "--backend",
+                        help="interpreter or compiled",
+                        default="interpreter")
+    parser.add_argument("-o", "--optimize",
+                        help="run the peephole optimizer first",
+                        action="store_true")
+    arguments = parser.parse_args()
+
+    lang = Language("morningtoncrescent")
+    examples = os.path.join(path, "modules", "morningtoncrescent", "examples")
+    for filename in sorted(glob.glob(os.path.join(examples, "*.mcresc"))):
+        with open(filename) as script:
+            code = script.read()
+        name = os.path.basename(filename)
+        runs = [measure(lang.interpreter_class, code, inputs.get(name, ""),
+                        backend=arguments.backend, optimize=arguments.optimize)
+                for _ in range(arguments.repeat)]
+        steps, seconds = min(runs, key=lambda run: run[1])
+        print("%-26s %8d steps %9.4fs %12.0f steps/s" % (name, steps, seconds, steps / seconds))
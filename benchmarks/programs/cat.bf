@@ -0,0 +1,2 @@
+Copy the input to the output
+,[.,]
@@ -0,0 +1,3 @@
+++++++++++++++++++++++++++++++[>++++++++++++++++++++++++++++++[>++++++++++++++++++++++++++++++[>++++++++++++++++[--]<-]<-]<-]
+Print A when done
+++++++++[>++++++++<-]>+.[-]++++++++++.
@@ -0,0 +1,2 @@
+Read the whole input and print it backwards
+>,[>,]<[.<]
@@ -0,0 +1,260 @@
+#!/usr/local/bin/python
+"""
+
+Benchmark suite and regression tracker for the interpreters
+Usage: python benchmarks/suite.py [--repeat N] [--backend NAME] [--output FILE]
+       python benchmarks/suite.py --compare BASELINE [RESULTS] [--threshold T]
+
+Runs the bundled Mornington Crescent examples and a set of heavy Brainfuck
+programs, each in a fresh process, and reports the fastest of several warm
+runs, steps per second, the peak resident set size and the startup time
+(importing the interpreter, loading the program and building the first
+interpreter) separately. Results can be written to JSON and compared with
+an earlier run, the exit status is 1 if anything got slower or bigger by
+more than the threshold.
+
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory isn't reported there
+    resource = None
+
+path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+programs = os.path.join(path, "benchmarks", "programs")
+
+# name, language, script and stdin of every benchmark, stdin given either
+# as text or as the number of bytes of generated text
+benchmarks = [
+    ("mc/calculator", "morningtoncrescent",
+     os.path.join(path, "modules", "morningtoncrescent", "examples", "calculator.mcresc"), "1234*5678"),
+    ("mc/hello-world", "morningtoncrescent",
+     os.path.join(path, "modules", "morningtoncrescent", "examples", "hello-world.mcresc"), ""),
+    ("mc/prime-number-test", "morningtoncrescent",
+     os.path.join(path, "modules", "morningtoncrescent", "examples", "prime-number-test.mcresc"), "7919"),
+    ("bf/squares", "brainfuck",
+     os.path.join(path, "modules", "brainfuck", "examples", "squares.bf"), ""),
+    ("bf/sierpinski", "brainfuck",
+     os.path.join(path, "modules", "brainfuck", "examples", "sierpinski.bf"), ""),
+    ("bf/nested-loops", "brainfuck", os.path.join(programs, "nested-loops.bf"), ""),
+    ("bf/cat", "brainfuck", os.path.join(programs, "cat.bf"), 2**18),
+    ("bf/reverse", "brainfuck", os.path.join(programs, "reverse.bf"), 20000),
+]
+
+# Metrics compared between runs, all of them lower is better, with the
+# smallest absolute increase counted as regression so that timer noise on
+# very short runs doesn't
+metrics = (("time", 0.005), ("startup", 0.005), ("peak_rss", 1024))
+
+def generated_text(size):
+    """Deterministic text of size bytes, so runs get the same input"""
+    line = "The quick brown fox jumps over the lazy dog 0123456789\n"
+    return (line * (size // len(line) + 1))[:size]
+
+def measure(language_name, script, stdin, repeat, options):
+    """
+    Run one benchmark in the current process
+
+    The language is loaded through Language the same way the CLI does.
+
+    Returns a dict with the "steps", the fastest run's "time", all run
+    "times", "steps_per_second", the "startup" time and the "peak_rss" in
+    KiB, None where unknown.
+    """
+    if isinstance(stdin, int):
+        stdin = generated_text(stdin)
+    with open(script) as script_file:
+        code = script_file.read()
+
+    start = time.perf_counter()
+    sys.path.insert(0, path)
+    from esoterpret.interpreter.output import CaptureSink
+    from esoterpret.language import Language
+    interpreter_class = Language(language_name).interpreter_class
+    interpreter = interpreter_class(code, io.StringIO(stdin), sink=CaptureSink(), **options)
+    startup = time.perf_counter() - start
+
+    # The first run is only a warm-up
+    times = []
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        steps = interpreter.run()
+        times.append(time.perf_counter() - start)
+        interpreter = interpreter_class(code, io.StringIO(stdin), sink=CaptureSink(), **options)
+    times = times[1:]
+
+    peak_rss = None
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            # Bytes instead of KiB
+            peak_rss //= 1024
+    best = min(times)
+    return {"steps": steps, "time": best, "times": times,
+            "steps_per_second": steps / best if best else None,
+            "startup": startup, "peak_rss": peak_rss}
+
+def run_suite(names, repeat, options):
+    """
+    Run benchmarks, each in a fresh process so startup time and peak
+    memory aren't shared between them
+
+    Arguments:
+        names -- names of the benchmarks to run, None for all
+        repeat -- warm runs per benchmark
+        options -- interpreter options passed to every benchmark
+
+    Returns the results as a dict, keyed by benchmark name under "benchmarks".
+    """
+    results = {}
+    for name, language_name, script, stdin in benchmarks:
+        if names and name not in names:
+            continue
+        language_options = dict(options)
+        if language_name != "morningtoncrescent":
+            # Only Mornington Crescent has an optimizer
+            language_options.pop("optimize", None)
+        job = json.dumps([language_name, script, stdin, repeat, language_options])
+        child = subprocess.run([sys.executable, os.path.realpath(__file__), "--child", job],
+                               stdout=subprocess.PIPE, universal_newlines=True)
+        if child.returncode:
+            raise RuntimeError("benchmark %s failed" % name)
+        results[name] = json.loads(child.stdout)
+        print(format_result(name, results[name]), file=sys.stderr)
+    return {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "options": options,
+            "repeat": repeat,
+            "benchmarks": results}
+
+def format_result(name, result):
+    return "%-22s %9d steps %9.4fs %12.0f steps/s  startup %7.4fs  peak %s" % (
+        name, result["steps"], result["time"], result["steps_per_second"] or 0,
+        result["startup"], "%d KiB" % result["peak_rss"] if result["peak_rss"] else "?")
+
+def compare(baseline, results, threshold):
+    """
+    Compare two suite results
+
+    Arguments:
+        baseline -- the earlier results
+        results -- the new results
+        threshold -- relative increase of a metric counted as regression,
+                     e.g. 0.1 for 10%, increases below the metric's noise
+                     level never are
+
+    Returns the lines of a report and the list of regressions as
+    (benchmark, metric, ratio) tuples.
+    """
+    lines = ["%-22s %9s %9s %9s  %s" % ("benchmark", "time", "startup", "peak_rss", "")]
+    regressions = []
+    for name, result in sorted(results["benchmarks"].items()):
+        old = baseline["benchmarks"].get(name)
+        if old is None:
+            lines.append("%-22s new" % name)
+            continue
+        ratios = []
+        notes = []
+        for metric, noise in metrics:
+            if not(old.get(metric)) or result.get(metric) is None:
+                ratios.append("%9s" % "-")
+                continue
+            ratio = result[metric] / old[metric]
+            ratios.append("%8.2fx" % ratio)
+            if ratio > 1 + threshold and result[metric] - old[metric] > noise:
+                regressions.append((name, metric, ratio))
+                notes.append(metric + " regressed")
+        if result["steps"] != old["steps"]:
+            notes.append("steps changed from %d to %d" % (old["steps"], result["steps"]))
+        lines.append("%-22s %s  %s" % (name, " ".join(ratios), ", ".join(notes)))
+    for name in sorted(set(baseline["benchmarks"]) - set(results["benchmarks"])):
+        lines.append("%-22s missing" % name)
+    return lines, regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    Benchmark the interpreters and compare results with an earlier run""")
+    parser.add_argument("names",
+                        help="benchmarks to run, all by default",
+                        nargs="*")
+    parser.add_argument("-r", "--repeat",
+                        help="warm runs per benchmark, the fastest one is reported",
+                        type=int,
+                        default=5)
+    parser.add_argument("-b", "--backend",
+                        help="interpreter or compiled",
+                        default="interpreter")
+    parser.add_argument("--optimize",
+                        help="run the Mornington Crescent peephole optimizer first",
+                        action="store_true")
+    parser.add_argument("--no-cache",
+                        help="don't use the on-disk program cache, so startup includes parsing",
+                        action="store_true")
+    parser.add_argument("-o", "--output",
+                        help="write the results to this JSON file")
+    parser.add_argument("-c", "--compare",
+                        help="compare with earlier results, a second file instead of running the suite",
+                        nargs="+",
+                        metavar="FILE")
+    parser.add_argument("-t", "--threshold",
+                        help="relative slowdown counted as regression (default 0.1)",
+                        type=float,
+                        default=0.1)
+    parser.add_argument("--child",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--list",
+                        help="list the benchmarks",
+                        action="store_true")
+    arguments = parser.parse_args()
+
+    if arguments.child:
+        language_name, script, stdin, repeat, options = json.loads(arguments.child)
+        print(json.dumps(measure(language_name, script, stdin, repeat, options)))
+        sys.exit(0)
+
+    if arguments.list:
+        for name, _, _, _ in benchmarks:
+            print(name)
+        sys.exit(0)
+
+    if arguments.no_cache:
+        # Inherited by the benchmark processes
+        os.environ["ESOTERPRET_NO_CACHE"] = "1"
+
+    if arguments.compare and len(arguments.compare) > 2:
+        parser.error("--compare takes a baseline and optionally the results to compare")
+    unknown = set(arguments.names) - set(name for name, _, _, _ in benchmarks)
+    if unknown:
+        parser.error("unknown benchmarks: " + ", ".join(sorted(unknown)))
+
+    if arguments.compare and len(arguments.compare) == 2:
+        with open(arguments.compare[1]) as results_file:
+            results = json.load(results_file)
+    else:
+        options = {"backend": arguments.backend}
+        if arguments.optimize:
+            options["optimize"] = True
+        results = run_suite(arguments.names, arguments.repeat, options)
+        if arguments.output:
+            with open(arguments.output, "w") as output_file:
+                json.dump(results, output_file, indent=2)
+
+    if arguments.compare:
+        with open(arguments.compare[0]) as baseline_file:
+            baseline = json.load(baseline_file)
+        lines, regressions = compare(baseline, results, arguments.threshold)
+        print("\n".join(lines))
+        if regressions:
+            print("%d regressions above %d%%" % (len(regressions), arguments.threshold * 100))
+            sys.exit(1)
@@ -11,35 +11,68 @@ Repository: https://github.com/Padarom/Esoterpret
 import argparse
 import inspect
 import io
+import json
 import os
 import sys
 
+from esoterpret.interpreter.baseclass import BudgetExceeded
+from esoterpret.interpreter.input import open_input
 from esoterpret.language import Language
+from esoterpret.registry import LanguageRegistry
 from esoterpret.terminal import Color
 
 # Add current path to sys.path, so we can import modules
 path = os.path.dirname(os.path.realpath(__file__))
 
 def list_languages():
-    modules_dir = os.path.join(path, "modules")
-    for item in os.listdir(modules_dir):
-        if os.path.isdir(os.path.join(modules_dir, item)) and item != "__pycache__":
-            try:
-                language = Language(item)
-                print("- %s%s %s(%s)" % (Color.BOLD, language.config["name"], Color.NORMAL, item))
-            except:
-                pass
-
-def use_language(language, code, stdin, extra_args):
+    registry = LanguageRegistry()
+    for language in registry.languages():
+        print("- %s%s %s(%s)" % (Color.BOLD, language.config["name"], Color.NORMAL, language.name))
+    for name, problem in registry.problems:
+        print("Skipping %s: %s" % (name, problem), file=sys.stderr)
+
+def check_language(language, code):
+    try:
+        lang = Language(language)
+    except FileNotFoundError:
+        print("Unknown language: %s" % language)
+        return False
+    else:
+        problems = lang.interpreter_class.check(code)
+        for problem in problems:
+            print(problem)
+        return not(problems)
+
+def use_language(language, code, stdin, extra_args, limits):
     try:
         lang = Language(language)
     except FileNotFoundError:
         print("Unknown language: %s" % language)
     else:
         extrakws, extrapos = parse_extra_args(extra_args, lang, language)
+        extrakws.update(limits)
         interpreter = lang.interpreter_class(code, stdin, *extrapos, **extrakws)
-        while not(interpreter.has_execution_finished()):
-            interpreter.next_instruction()
+        stopped = None
+        try:
+            interpreter.run()
+        except BudgetExceeded as error:
+            stopped = error
+        if extrakws.get("optimize") and not(extrakws.get("profile")):
+            # A profile reports them already
+            print("%d steps saved by the optimizer" % interpreter.steps_saved, file=sys.stderr)
+        if stopped is not None:
+            sys.exit("Stopped: %s" % stopped)
+
+def batch(jobs, workers, results):
+    """Run jobs in parallel, writing one JSON result per line"""
+    from esoterpret.batch import run_batch
+    failed = False
+    for result in run_batch(jobs, workers):
+        results.write(json.dumps(result) + "\n")
+        results.flush()
+        failed = failed or result["status"] != "ok"
+    return not(failed)
+
 def parse_extra_args(extra, langc, langname):
     sig = inspect.signature(langc.interpreter_class.__init__)
     Parameter = inspect.Parameter
@@ -47,6 +80,7 @@ def parse_extra_args(extra, langc, langname):
     Esoterpret, interpreter and debugger for esoteric programming languages""" ,
     prog='esoterpret -l %s' %langname, add_help=False)
     skip_params = 3 # ignore the required arguments of "self", "code", "stdin"
+    short_flags = set()
     for param in sig.parameters.values():
         if skip_params and param.kind == Parameter.POSITIONAL_OR_KEYWORD:
             skip_params -= 1
@@ -57,20 +91,22 @@ def parse_extra_args(extra, langc, langname):
             parser.add_argument(param.name, nargs="*",dest="__VARARGS")
         else:
             default = param.default
-            action = "store"
-            required = False
+            options = {"action": "store", "default": default}
             if default == Parameter.empty:
-                required = True
+                options["required"] = True
             elif type(default) == bool:
                 if default:
-                    action = "store_false"
+                    options["action"] = "store_false"
                 else:
-                    action = "store_true"
-            parser.add_argument("--" + param.name,
-                        "-" + param.name[0],
-                        action=action,
-                        default=default,
-                        required=required)
+                    options["action"] = "store_true"
+            elif type(default) in (int, float):
+                options["type"] = type(default)
+            flags = ["--" + param.name]
+            # Options sharing a first letter only get the first short flag
+            if param.name[0] not in short_flags:
+                short_flags.add(param.name[0])
+                flags.append("-" + param.name[0])
+            parser.add_argument(*flags, **options)
     ns = parser.parse_args(extra)
     kwargs = ns.__dict__
     return kwargs, kwargs.pop("__VARARGS", [])
@@ -94,32 +130,151 @@ if __name__ == "__main__":
                         type=io.StringIO,
                         default=sys.stdin)
 
-    exclusive = parser.add_mutually_exclusive_group(required=True)
+    parser.add_argument("--stdin-file",
+                        help="file to read stdin from, mapped into memory if possible",
+                        metavar="PATH")
+
+    parser.add_argument("--batch",
+                        help="run many scripts in parallel and print JSON lines results",
+                        metavar="SCRIPT",
+                        nargs="*")
+
+    parser.add_argument("--manifest",
+                        help="JSON lines file of batch jobs with per-script stdin")
+
+    parser.add_argument("-j", "--workers",
+                        help="number of batch or server worker processes (default: one per CPU)",
+                        type=int)
+
+    parser.add_argument("--golf",
+                        help="codegolf challenge: a test suite followed by candidate scripts",
+                        metavar="FILE",
+                        nargs="+")
+
+    parser.add_argument("--serve",
+                        help="run a resident server taking JSON-RPC jobs on a Unix socket, "
+                             "or on stdin/stdout if no socket is given",
+                        metavar="SOCKET",
+                        nargs="?",
+                        const="-")
+
+    parser.add_argument("--json",
+                        help="print codegolf results as JSON",
+                        action="store_true")
+
+    parser.add_argument("--max-steps",
+                        help="stop programs running more steps than this",
+                        type=int)
+
+    parser.add_argument("--max-time",
+                        help="stop programs running longer than this many seconds",
+                        type=float)
+
+    parser.add_argument("--max-output",
+                        help="stop programs writing more bytes than this, UTF-8 encoded",
+                        type=int)
+
+    parser.add_argument("--no-cache",
+                        help="don't use the on-disk cache of compiled programs",
+                        action="store_true")
+
+    parser.add_argument("--check",
+                        help="validate the script without running it",
+                        action="store_true")
+
+    exclusive = parser.add_mutually_exclusive_group()
 
     exclusive.add_argument("--list-languages",
                         help="list available languages",
                         action="store_true")
     
     exclusive.add_argument("-l", "--language",
-                        help="the language you want to execute")
+                        help="the language you want to execute, "
+                             "detected from the file extension if omitted")
 
     exclusive.add_argument("--gui",
                         help="open the gui [WIP]",
                         action="store_true")
 
     arguments, extra = parser.parse_known_args()
+
+    if arguments.no_cache:
+        # Inherited by batch and golf worker processes
+        os.environ["ESOTERPRET_NO_CACHE"] = "1"
+
+    if arguments.stdin_file:
+        if arguments.stdin != sys.stdin:
+            parser.error("-s and --stdin-file can't be used together")
+        if arguments.batch is None and not(arguments.manifest):
+            arguments.stdin = open_input(arguments.stdin_file)
+
+    limits = {}
+    for option, limit in (("step_limit", arguments.max_steps),
+                          ("time_limit", arguments.max_time),
+                          ("output_limit", arguments.max_output)):
+        if limit is not None:
+            limits[option] = limit
     
     if arguments.gui:
         parser.error("GUI not currently implemented")
+    elif arguments.golf:
+        if arguments.script or extra:
+            parser.error("candidates are given after the suite with --golf")
+        # Pool and server modules are only imported when used, they slow
+        # down starting a single script
+        from esoterpret.golf import format_report, load_suite, run_challenge
+        suite = load_suite(arguments.golf[0])
+        results = run_challenge(suite, arguments.golf[1:], arguments.workers)
+        if arguments.json:
+            print(json.dumps(results, indent=4))
+        else:
+            print(format_report(suite, results))
+    elif arguments.serve is not None:
+        if arguments.script or extra:
+            parser.error("scripts and interpreter options are sent in the requests with --serve")
+        from esoterpret.server import serve
+        serve(None if arguments.serve == "-" else arguments.serve, arguments.workers,
+              {key: limit for key, limit in (("max_steps", arguments.max_steps),
+                                             ("max_time", arguments.max_time),
+                                             ("max_output", arguments.max_output))
+               if limit is not None},
+              [arguments.language] if arguments.language else None)
+    elif arguments.batch is not None or arguments.manifest:
+        if arguments.script or extra:
+            parser.error("scripts and interpreter options go into the manifest with --batch")
+        from esoterpret.batch import load_manifest
+        jobs = [{"script": script} for script in arguments.batch or []]
+        if arguments.manifest:
+            jobs.extend(load_manifest(arguments.manifest))
+        for job in jobs:
+            if arguments.language:
+                job.setdefault("language", arguments.language)
+            if arguments.stdin != sys.stdin:
+                job.setdefault("stdin", arguments.stdin.getvalue())
+            elif arguments.stdin_file and "stdin" not in job:
+                job.setdefault("stdin_file", os.path.abspath(arguments.stdin_file))
+            job["options"] = dict(limits, **job.get("options", {}))
+        if not(batch(jobs, arguments.workers, sys.stdout)):
+            sys.exit(1)
     elif arguments.list_languages:
         if arguments.script or arguments.stdin != sys.stdin or extra:
             parser.error("extra arguments given with --list-languages")
         list_languages()
     else:
         if arguments.script:
+            language = arguments.language
+            if not(language):
+                detected = LanguageRegistry().for_file(arguments.script.name)
+                if detected is None:
+                    parser.error("unknown file extension, specify the language with -l")
+                language = detected.name
             code = arguments.script.read()
             arguments.script.close()
-            use_language(arguments.language, code,
-                         arguments.stdin, extra)
+            if arguments.check:
+                if not(check_language(language, code)):
+                    sys.exit(1)
+            else:
+                use_language(language, code,
+                             arguments.stdin, extra, limits)
         else:
             parser.error("no file to execute specified")
@@ -0,0 +1,269 @@
+"""
+Run many scripts at once across a pool of worker processes
+"""
+
+import io
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from esoterpret.interpreter.baseclass import BudgetExceeded
+from esoterpret.interpreter.input import open_input
+from esoterpret.interpreter.output import CaptureSink
+from esoterpret.registry import LanguageRegistry
+
+# Registry of the current worker process, so every language is loaded once
+_registry = None
+
+# Shared slots the workers of a RecoveringPool note their current job in,
+# and the current worker's slot
+_slots = None
+_slot = None
+
+def worker_registry():
+    """The LanguageRegistry of the current process, created on first use"""
+    global _registry
+    if _registry is None:
+        _registry = LanguageRegistry()
+    return _registry
+
+def load_manifest(manifest_file):
+    """
+    Read jobs from a JSON lines manifest
+
+    Every line is an object with a "script" path, relative to the manifest,
+    and optionally the "language", the "stdin" text or a "stdin_file" path
+    and interpreter "options". Blank lines are skipped.
+
+    Arguments:
+        manifest_file -- the manifest's path
+    """
+    directory = os.path.dirname(os.path.abspath(manifest_file))
+    jobs = []
+    with open(manifest_file) as manifest:
+        for number, line in enumerate(manifest, 1):
+            if not(line.strip()):
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as error:
+                raise ValueError("line %d of %s: %s" % (number, manifest_file, error))
+            if not(isinstance(job, dict)) or "script" not in job:
+                raise ValueError("line %d of %s: a job needs a \"script\"" % (number, manifest_file))
+            job["script"] = os.path.join(directory, job["script"])
+            if "stdin_file" in job:
+                job["stdin_file"] = os.path.join(directory, job["stdin_file"])
+            jobs.append(job)
+    return jobs
+
+def run_job(job):
+    """
+    Run a single job in the current process and describe the result
+
+    Arguments:
+        job -- dict with the "script" path, or the "code" itself and its
+               "language", and optionally the "language", the "stdin" text
+               or a "stdin_file" path and interpreter "options"
+
+    Returns a dict with the script, language, status ("ok", "error" or
+    "budget_exceeded"), the output, the number of steps, the wall time in
+    seconds and for failed jobs the error. Jobs stopped by one of their
+    limits also name the exceeded "resource", and jobs with the optimize
+    option give the "steps_saved" by the optimizer.
+    """
+    registry = worker_registry()
+    result = {"script": job.get("script"), "language": job.get("language"),
+              "status": "ok", "stdout": "", "steps": 0, "time": 0.0}
+    sink = CaptureSink()
+    interpreter = None
+    start = time.perf_counter()
+    try:
+        if result["language"]:
+            language = registry.get(result["language"])
+        else:
+            language = registry.for_file(job.get("script", ""))
+            if language is None:
+                raise ValueError("unknown file extension, the job needs a \"language\"")
+            result["language"] = language.name
+        if "code" in job:
+            code = job["code"]
+        else:
+            with open(job["script"]) as script:
+                code = script.read()
+        if "stdin_file" in job:
+            stdin = open_input(job["stdin_file"])
+        else:
+            stdin = io.StringIO(job.get("stdin", ""))
+        interpreter = language.interpreter_class(code, stdin, sink=sink, **job.get("options", {}))
+        result["steps"] = interpreter.run()
+    except BudgetExceeded as error:
+        result["status"] = "budget_exceeded"
+        result["error"] = str(error)
+        result["resource"] = error.resource
+        result["steps"] = error.steps
+    except Exception as error:
+        result["status"] = "error"
+        result["error"] = "%s: %s" % (type(error).__name__, error)
+    result["time"] = time.perf_counter() - start
+    result["stdout"] = sink.getvalue()
+    if interpreter is not None and job.get("options", {}).get("optimize"):
+        result["steps_saved"] = interpreter.steps_saved
+    return result
+
+def _initialize_worker(slots):
+    """Claim a free slot, marked -2, for the current worker process"""
+    global _slots, _slot
+    with slots.get_lock():
+        _slot = list(slots).index(-2)
+        slots[_slot] = -1
+    _slots = slots
+
+def _call_tracked(key, function, arguments):
+    """Call function, noting the job's key in the worker's slot meanwhile"""
+    _slots[_slot] = key
+    try:
+        return function(*arguments)
+    finally:
+        _slots[_slot] = -1
+
+class RecoveringPool:
+    """
+    A pool of worker processes that survives a worker dying
+
+    A worker dying, e.g. killed for running out of memory, breaks a
+    ProcessPoolExecutor and fails every job still pending in it. Here the
+    jobs that hadn't started yet are resubmitted to a fresh pool and those
+    that were running are retried in a pool of their own each, so only the
+    job that killed its worker fails.
+    """
+
+    def __init__(self, workers = None):
+        """
+        Arguments:
+            workers -- number of worker processes, None for one per CPU
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = None
+        self._slots = None
+        # Every job's future, with its key, function, arguments and executor
+        self._futures = {}
+        self._cancelled = set()
+        self._next_key = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *error):
+        self.shutdown()
+
+    def submit(self, function, *arguments):
+        """Run function(*arguments) in a worker, returns the job's key"""
+        key = self._next_key
+        self._next_key += 1
+        self._submit(key, function, arguments)
+        return key
+
+    def cancel(self, key):
+        """Drop a job, if it is running its result is ignored"""
+        self._cancelled.add(key)
+        for future, (other, _, _, _) in self._futures.items():
+            if other == key:
+                future.cancel()
+
+    def completed(self):
+        """
+        Yield (key, result, error) for every job as it completes, error
+        being the exception the job raised or None
+        """
+        while self._futures:
+            done, _ = wait(self._futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future not in self._futures:
+                    # Already handled along with its broken executor
+                    continue
+                key, _, _, executor = self._futures[future]
+                if executor is self._executor and _broke(future):
+                    yield from self._recover()
+                    continue
+                del self._futures[future]
+                if executor is not self._executor:
+                    # A job retried on its own
+                    executor.shutdown(wait=False)
+                if not(future.cancelled()) and key not in self._cancelled:
+                    yield (key,) + _outcome(future)
+
+    def shutdown(self):
+        for future, (_, _, _, executor) in list(self._futures.items()):
+            future.cancel()
+            if executor is not self._executor:
+                executor.shutdown(wait=False)
+        self._futures = {}
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _submit(self, key, function, arguments, alone = False):
+        if alone:
+            executor = ProcessPoolExecutor(max_workers=1)
+            future = executor.submit(function, *arguments)
+        else:
+            if self._executor is None:
+                self._slots = multiprocessing.Array("q", [-2] * self.workers)
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     initializer=_initialize_worker,
+                                                     initargs=(self._slots,))
+            executor = self._executor
+            future = executor.submit(_call_tracked, key, function, arguments)
+        self._futures[future] = (key, function, arguments, executor)
+
+    def _recover(self):
+        """Handle the jobs of the broken executor and resubmit them"""
+        broken = self._executor
+        futures = [future for future, entry in self._futures.items() if entry[3] is broken]
+        wait(futures)
+        running = set(key for key in self._slots if key >= 0)
+        self._executor = None
+        broken.shutdown(wait=False)
+        for future in futures:
+            key, function, arguments, _ = self._futures.pop(future)
+            if future.cancelled() or key in self._cancelled:
+                continue
+            if _broke(future):
+                self._submit(key, function, arguments, key in running)
+            else:
+                yield (key,) + _outcome(future)
+
+def _broke(future):
+    """Whether a job failed because its executor broke"""
+    return not(future.cancelled()) and isinstance(future.exception(), BrokenProcessPool)
+
+def _outcome(future):
+    """The result and the exception of a finished job"""
+    error = future.exception()
+    return (None if error else future.result()), error
+
+def run_batch(jobs, workers = None):
+    """
+    Run jobs across a pool of worker processes
+
+    Arguments:
+        jobs -- list of jobs as accepted by run_job
+        workers -- number of worker processes, None for one per CPU
+
+    Yields the result of every job as it completes, with the job's position
+    in jobs added as "index".
+    """
+    with RecoveringPool(workers) as pool:
+        keys = {pool.submit(run_job, job): index for index, job in enumerate(jobs)}
+        for key, result, error in pool.completed():
+            index = keys[key]
+            if error is not None:
+                # The worker itself died, e.g. killed for running out of memory
+                result = {"script": jobs[index].get("script"), "language": jobs[index].get("language"),
+                          "status": "error", "stdout": "", "steps": 0, "time": 0.0,
+                          "error": "%s: %s" % (type(error).__name__, error)}
+            result["index"] = index
+            yield result
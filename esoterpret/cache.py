@@ -0,0 +1,165 @@
+import hashlib
+import os
+import pickle
+import sys
+
+def cache_directory():
+    """
+    Directory esoterpret keeps its caches in
+
+    ESOTERPRET_CACHE_DIR overrides the default location, which is
+    $XDG_CACHE_HOME/esoterpret or ~/.cache/esoterpret.
+    """
+    directory = os.environ.get("ESOTERPRET_CACHE_DIR")
+    if not(directory):
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        directory = os.path.join(base, "esoterpret")
+    return directory
+
+def source_version(*files):
+    """
+    Version of the code in some source files, for keys of cached data
+    built by that code
+
+    Changes whenever the Python version or one of the files changes.
+    """
+    parts = [sys.version]
+    for path in files:
+        stat = os.stat(path)
+        parts.append("%s:%d:%d" % (os.path.basename(path), stat.st_mtime_ns, stat.st_size))
+    return "|".join(parts)
+
+def cache_enabled():
+    """Whether the program cache is used, which ESOTERPRET_NO_CACHE turns off"""
+    return not(os.environ.get("ESOTERPRET_NO_CACHE"))
+
+class ProgramCache:
+    """
+    Content-addressed on-disk cache of compiled programs
+
+    Entries are pickled, keyed by a hash of what they were built from. Once
+    the cache grows beyond its size, the least recently used entries are
+    removed. The total size is kept in a file next to the entries, so only
+    writes that take the cache over its size have to scan all entries.
+    The total can be off when processes write at the same time, which the
+    next scan corrects.
+    """
+
+    def __init__(self, directory = None, max_size = 64 * 2 ** 20):
+        """
+        Arguments:
+            directory -- where to keep the entries, None for the cache directory
+            max_size -- size in bytes the entries may take up together
+        """
+        self.directory = directory or os.path.join(cache_directory(), "programs")
+        self.max_size = max_size
+
+    def key(self, kind, language, version, source):
+        """
+        Key of an entry
+
+        Arguments:
+            kind -- what the entry holds, e.g. "program"
+            language -- the language module's name
+            version -- version of the code building the entry, see source_version
+            source -- the program's source, and anything else the entry depends on
+        """
+        digest = hashlib.sha256()
+        for part in (kind, language, version, source):
+            digest.update(part.encode("utf-8", "surrogateescape") + b"\0")
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the entry of a key, None if there is none"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as entry:
+                value = pickle.load(entry)
+            # The modification time marks when an entry was last used
+            os.utime(path)
+        except Exception:
+            return None
+        return value
+
+    def put(self, key, value):
+        """Store an entry, failing to write it is not an error"""
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = path + ".%d.tmp" % os.getpid()
+            with open(temporary, "wb") as entry:
+                pickle.dump(value, entry, pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, path)
+            size = self._read_size()
+            if size is None:
+                self.evict()
+            else:
+                size += os.stat(path).st_size
+                if size > self.max_size:
+                    self.evict()
+                else:
+                    self._write_size(size)
+        except OSError:
+            pass
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits its
+        size, with a tenth of it left free so that the next writes don't
+        have to scan again right away
+        """
+        entries = []
+        for subdirectory in os.scandir(self.directory):
+            if subdirectory.is_dir():
+                for entry in os.scandir(subdirectory.path):
+                    if entry.name.endswith(".pickle"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        size = sum(entry[1] for entry in entries)
+        entries.sort()
+        for _, entry_size, path in entries:
+            if size <= self.max_size * 9 // 10:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
+        self._write_size(size)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".pickle")
+
+    def _read_size(self):
+        """The total size of the entries, None if it isn't known"""
+        try:
+            with open(os.path.join(self.directory, "size")) as size_file:
+                return int(size_file.read())
+        except (OSError, ValueError):
+            return None
+
+    def _write_size(self, size):
+        path = os.path.join(self.directory, "size")
+        temporary = path + ".%d.tmp" % os.getpid()
+        with open(temporary, "w") as size_file:
+            size_file.write(str(size))
+        os.replace(temporary, path)
+
+def cached(kind, language, version, source, build):
+    """
+    Build a value, or load it from the program cache if it was built
+    from the same source before
+
+    Arguments:
+        kind, language, version, source -- what the value depends on, see ProgramCache.key
+        build -- function returning the value, which has to be picklable
+    """
+    if not(cache_enabled()):
+        return build()
+    cache = ProgramCache()
+    key = cache.key(kind, language, version, source)
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.put(key, value)
+    return value
@@ -0,0 +1,210 @@
+"""
+Codegolf Challenge Mode
+
+A test suite is a JSON file:
+
+    {
+        "name": "Primality test",
+        "language": "morningtoncrescent",
+        "limits": {"max_steps": 1000000, "max_time": 5, "max_output": 1000},
+        "exact": false,
+        "cases": [
+            {"input": "7", "output": "1"},
+            {"input": "8", "output": "0"}
+        ],
+        "candidates": ["golfed.mcresc"]
+    }
+
+Only "cases" is required. Without a "language", every candidate's language
+is detected from its file extension. Unless "exact" is true, trailing
+whitespace is ignored when comparing outputs. Candidate paths are relative
+to the suite file and can also be given on the command line.
+
+Every candidate is run against every case across a pool of worker
+processes, a candidate is dropped at its first failing case. Candidates
+passing all cases are ranked by byte count.
+"""
+
+import io
+import json
+import os
+import time
+
+from esoterpret.batch import RecoveringPool, worker_registry
+from esoterpret.interpreter.baseclass import BudgetExceeded
+from esoterpret.interpreter.output import CaptureSink
+
+# Interpreters of the current worker process that haven't run yet, cloned
+# for every case so a candidate is only compiled once per process
+_templates = {}
+_max_templates = 32
+
+def load_suite(suite_file):
+    """
+    Read and validate a test suite
+
+    Arguments:
+        suite_file -- the suite's path
+    """
+    with open(suite_file) as suite_json:
+        suite = json.load(suite_json)
+    if not(isinstance(suite, dict)) or not(isinstance(suite.get("cases"), list)):
+        raise ValueError("%s: a suite needs a list of \"cases\"" % suite_file)
+    for number, case in enumerate(suite["cases"], 1):
+        if not(isinstance(case, dict)) or "output" not in case:
+            raise ValueError("%s: case %d has no \"output\"" % (suite_file, number))
+    directory = os.path.dirname(os.path.abspath(suite_file))
+    suite["candidates"] = [os.path.join(directory, candidate)
+                           for candidate in suite.get("candidates", [])]
+    suite.setdefault("name", os.path.basename(suite_file))
+    return suite
+
+def run_case(language_name, code, case, limits, exact):
+    """
+    Run a candidate against a single test case in the current process
+
+    Arguments:
+        language_name -- the candidate's language
+        code -- the candidate's source
+        case -- dict with the "input" and expected "output"
+        limits -- dict with optional "max_steps", "max_time" in seconds and
+                  "max_output" in bytes
+        exact -- whether trailing whitespace has to match as well
+
+    Returns a dict telling whether the case "passed", why it failed
+    ("reason"), the "output", number of "steps" and "time" taken.
+    """
+    result = {"passed": False, "reason": None, "output": "", "steps": 0, "time": 0.0}
+    sink = CaptureSink()
+    start = time.perf_counter()
+    try:
+        template = _template(language_name, code, limits)
+        interpreter = template.clone(io.StringIO(case.get("input", "")), sink)
+        result["steps"] = interpreter.run()
+    except BudgetExceeded as error:
+        result["reason"] = str(error)
+        result["steps"] = error.steps
+    except Exception as error:
+        result["reason"] = "%s: %s" % (type(error).__name__, error)
+    result["time"] = time.perf_counter() - start
+    result["output"] = sink.getvalue()
+
+    if result["reason"] is None:
+        expected = case["output"]
+        output = result["output"]
+        if not(exact):
+            expected = expected.rstrip()
+            output = output.rstrip()
+        if output == expected:
+            result["passed"] = True
+        else:
+            result["reason"] = "wrong output"
+    return result
+
+def _template(language_name, code, limits):
+    """The unstarted interpreter of a candidate, created on first use"""
+    key = (language_name, code, tuple(sorted(limits.items())))
+    if key not in _templates:
+        if len(_templates) >= _max_templates:
+            _templates.clear()
+        language = worker_registry().get(language_name)
+        _templates[key] = language.interpreter_class(code, io.StringIO(""), sink=CaptureSink(),
+                                                     step_limit=limits.get("max_steps"),
+                                                     time_limit=limits.get("max_time"),
+                                                     output_limit=limits.get("max_output"))
+    return _templates[key]
+
+def run_challenge(suite, candidates = (), workers = None):
+    """
+    Test candidates against a suite and rank them
+
+    Arguments:
+        suite -- the suite as returned by load_suite
+        candidates -- paths of further candidates to test
+        workers -- number of worker processes, None for one per CPU
+
+    Returns a list with a dict per candidate, holding its "candidate"
+    path, "language", "bytes", whether it "passed", the number of
+    "cases" passed, total "steps" and "time" and for failed candidates
+    the "failure": the case's "index", "reason", "input", "expected"
+    and actual "output". Passing candidates come first, shortest first.
+    """
+    cases = suite["cases"]
+    limits = suite.get("limits", {})
+    exact = suite.get("exact", False)
+
+    results = []
+    for path in list(suite["candidates"]) + list(candidates):
+        result = {"candidate": path, "language": suite.get("language"), "bytes": None,
+                  "passed": False, "cases": 0, "steps": 0, "time": 0.0, "failure": None}
+        try:
+            with open(path, "rb") as candidate:
+                source = candidate.read()
+            result["bytes"] = len(source)
+            result["code"] = source.decode("utf-8")
+            if result["language"] is None:
+                language = worker_registry().for_file(path)
+                if language is None:
+                    raise ValueError("unknown file extension, the suite needs a \"language\"")
+                result["language"] = language.name
+        except (OSError, ValueError) as error:
+            result["failure"] = {"index": None, "reason": "%s: %s" % (type(error).__name__, error)}
+        results.append(result)
+
+    with RecoveringPool(workers) as pool:
+        pending = {}
+        for result in results:
+            if result["failure"] is None:
+                for index, case in enumerate(cases):
+                    key = pool.submit(run_case, result["language"], result["code"], case, limits, exact)
+                    pending[key] = (result, index)
+
+        for key, outcome, error in pool.completed():
+            result, index = pending.pop(key)
+            if result["failure"] is not None:
+                continue
+            if error is not None:
+                # The worker itself died, e.g. killed for running out of memory
+                outcome = {"passed": False, "reason": "%s: %s" % (type(error).__name__, error),
+                           "output": "", "steps": 0, "time": 0.0}
+            result["steps"] += outcome["steps"]
+            result["time"] += outcome["time"]
+            if outcome["passed"]:
+                result["cases"] += 1
+                continue
+
+            result["failure"] = {"index": index, "reason": outcome["reason"],
+                                 "input": cases[index].get("input", ""),
+                                 "expected": cases[index]["output"],
+                                 "output": outcome["output"]}
+            # Drop the candidate's remaining cases
+            for other, (owner, _) in list(pending.items()):
+                if owner is result:
+                    pool.cancel(other)
+                    del pending[other]
+
+    for result in results:
+        result.pop("code", None)
+        result["passed"] = result["failure"] is None and result["cases"] == len(cases)
+    results.sort(key=lambda result: (not(result["passed"]), result["bytes"] is None,
+                                     result["bytes"] or 0, result["steps"]))
+    return results
+
+def format_report(suite, results):
+    """Describe ranked challenge results as text"""
+    lines = ["%s: %d cases" % (suite["name"], len(suite["cases"]))]
+    rank = 0
+    for result in results:
+        if result["passed"]:
+            rank += 1
+            lines.append("%3d. %6d bytes  %10d steps  %8.3fs  %s" % (
+                rank, result["bytes"], result["steps"], result["time"], result["candidate"]))
+        else:
+            failure = result["failure"]
+            if failure["index"] is None:
+                reason = failure["reason"]
+            else:
+                reason = "case %d: %s" % (failure["index"] + 1, failure["reason"])
+            size = "%6d bytes" % result["bytes"] if result["bytes"] is not None else " " * 12
+            lines.append("   - %s  failed  %s  %s" % (size, result["candidate"], reason))
+    return "\n".join(lines)
@@ -1,24 +1,251 @@
+import copy
 import sys
+import time
 from abc import ABCMeta, abstractmethod
+from esoterpret.interpreter.debugger import Debugger
+from esoterpret.interpreter.input import InputReader
+from esoterpret.interpreter.output import BufferedSink
+
+class BudgetExceeded(RuntimeError):
+    """
+    Raised when a program exceeds one of its interpreter's limits
+
+    Attributes:
+        resource -- "steps", "time" or "output", or a limit of the
+                    interpreter's own, such as "int_bits" or
+                    "string_length" in Mornington Crescent
+        limit -- the limit that was exceeded
+        steps -- the number of steps executed when the limit was hit
+    """
+
+    def __init__(self, resource, limit, steps):
+        super().__init__("%s limit of %s exceeded" % (resource, limit))
+        self.resource = resource
+        self.limit = limit
+        self.steps = steps
+
+def _reader(stdin):
+    """Wrap a file-like object in an InputReader, unless it is one already"""
+    return stdin if isinstance(stdin, InputReader) else InputReader(stdin)
 
 class AbstractInterpreter(metaclass=ABCMeta):
     instruction_pointer = 0
+    # Steps executed by run() so far
+    steps = 0
+    # Number of steps run() executes between two checks of the time limit
+    check_interval = 10000
 
-    def __init__(self, code, stdin):
+    def __init__(self, code, stdin, sink = None, step_limit = None,
+                 time_limit = None, output_limit = None):
+        """
+        Arguments:
+            code -- the code to execute
+            stdin -- file-like object or InputReader to read input from
+            sink -- OutputSink to write output to, buffered stdout by default
+            step_limit -- maximum number of steps run() may execute
+            time_limit -- maximum wall time in seconds run() may take
+            output_limit -- maximum number of bytes the program may output, UTF-8 encoded
+        """
         self.code = code
         self.stdin = stdin or sys.stdin
+        self.reader = _reader(self.stdin)
+        self.sink = sink or BufferedSink()
+        # Pending output has to be shown before waiting for a user's input
+        self._interactive = self.stdin.isatty()
+
+        self.step_limit = step_limit
+        self.time_limit = time_limit
+        self.output_limit = output_limit
+        self.output_size = 0
+        self._deadline = None
 
     def output(self, text, newline = True):
-        if newline:
-            print("%s" % text)
-        else:
-            print("%s" % text, end="")
+        text = str(text) + "\n" if newline else str(text)
+        # Output is counted in UTF-8 encoded bytes, as written to stdout
+        self.output_size += len(text) if text.isascii() else len(text.encode("utf-8", "surrogateescape"))
+        if self.output_limit is not None and self.output_size > self.output_limit:
+            raise BudgetExceeded("output", self.output_limit, self.steps)
+        self.sink.write(text)
+
+    def flush(self):
+        """Write out any output still held by the sink"""
+        self.sink.flush()
 
     def input(self, character = False):
+        if self._interactive:
+            self.sink.flush()
         if character:
-            return self.stdin.read(1)
+            return self.reader.read_char()
         else:
-            return self.stdin.readline()
+            return self.reader.readline()
+
+    def input_byte(self):
+        """Read the next byte of UTF-8 encoded input, None at the end of input"""
+        if self._interactive:
+            self.sink.flush()
+        return self.reader.read_byte()
+
+    def debugger(self):
+        """
+        Create a Debugger to step through the program with breakpoints and
+        watches
+
+        Runs without a debugger are not slowed down by it.
+        """
+        return Debugger(self)
+
+    def instruction_name(self, index):
+        """
+        Name of the instruction at index that breakpoints by name refer to,
+        None if the interpreter doesn't name its instructions
+
+        Arguments:
+            index -- index of the instruction in the compiled code
+        """
+        return None
+
+    def snapshot(self):
+        """
+        Describe the execution state of the interpreter
+
+        The snapshot is built from dicts, lists, strings and integers only,
+        so it can be pickled, or written as JSON as long as every integer
+        can be converted to a string. It doesn't include the code,
+        it can only be restored into an interpreter for the same program.
+        Interpreters extend it with their own state.
+        """
+        return {"instruction_pointer": self.instruction_pointer,
+                "steps": self.steps,
+                "output_size": self.output_size}
+
+    def restore(self, snapshot):
+        """
+        Continue from a state returned by snapshot
+
+        Arguments:
+            snapshot -- the state, taken from an interpreter for the same code
+        """
+        self.instruction_pointer = snapshot["instruction_pointer"]
+        self.steps = snapshot["steps"]
+        self.output_size = snapshot["output_size"]
+
+    def clone(self, stdin = None, sink = None):
+        """
+        Create an interpreter in the same state, sharing the compiled code
+
+        Arguments:
+            stdin -- file-like object the clone reads from, the same as this one's by default
+            sink -- OutputSink to write output to, buffered stdout by default
+        """
+        clone = copy.copy(self)
+        clone.stdin = stdin or self.stdin
+        clone.reader = self.reader if stdin is None else _reader(stdin)
+        clone.sink = sink or BufferedSink()
+        clone._interactive = clone.stdin.isatty()
+        clone._deadline = None
+        clone.restore(self.snapshot())
+        return clone
+
+    @classmethod
+    def check(cls, code):
+        """
+        Validate code without executing it, returning a list of problems
+
+        Interpreters that can detect errors ahead of time override this,
+        by default every program is considered valid.
+        """
+        return []
+
+    def run(self, max_steps = None):
+        """
+        Execute instructions until the program has finished and flush the
+        output sink
+
+        With a step or time limit the program runs in chunks of
+        check_interval steps, and BudgetExceeded is raised once a limit is
+        exceeded.
+
+        Arguments:
+            max_steps -- stop after this many instructions, None for no limit
+
+        Returns the number of instructions executed.
+        """
+        error = None
+        try:
+            if self.step_limit is None and self.time_limit is None:
+                executed = self.execute(max_steps)
+                self.steps += executed
+                return executed
+            return self._run_budgeted(max_steps)
+        except BaseException as exception:
+            error = exception
+            raise
+        finally:
+            self.flush()
+            self.stopped(error)
+
+    def stopped(self, error):
+        """
+        Called whenever run returns or raises, after the output has been
+        flushed
+
+        Interpreters writing reports or traces override this to finish
+        them, also when a limit stopped the program.
+
+        Arguments:
+            error -- the exception run raises, None if it returns
+        """
+
+    def _run_budgeted(self, max_steps):
+        """Run in chunks of check_interval steps, checking the limits in between"""
+        if self.time_limit is not None and self._deadline is None:
+            self._deadline = time.perf_counter() + self.time_limit
+
+        executed = 0
+        while executed != max_steps:
+            chunk = self.check_interval
+            if max_steps is not None:
+                chunk = min(chunk, max_steps - executed)
+            if self.step_limit is not None:
+                if self.steps >= self.step_limit:
+                    if self.has_execution_finished():
+                        break
+                    raise BudgetExceeded("steps", self.step_limit, self.steps)
+                chunk = min(chunk, self.step_limit - self.steps)
+
+            done = self.execute(chunk)
+            executed += done
+            self.steps += done
+            if done < chunk or self.has_execution_finished():
+                break
+            if self._deadline is not None and time.perf_counter() > self._deadline:
+                raise BudgetExceeded("time", self.time_limit, self.steps)
+        return executed
+
+    def execute(self, max_steps = None):
+        """
+        Execute instructions until the program has finished, without
+        flushing the output
+
+        This steps through next_instruction, interpreters should override it
+        with a tighter loop. The step-by-step protocol is meant for debugging.
+
+        Arguments:
+            max_steps -- stop after this many instructions, None for no limit
+
+        Returns the number of instructions executed.
+        """
+        executed = 0
+        try:
+            while executed != max_steps and not(self.has_execution_finished()):
+                self.next_instruction()
+                executed += 1
+        except BudgetExceeded as error:
+            # Raised by an instruction, which only knows the steps counted
+            # before this call
+            error.steps = self.steps + executed
+            raise
+        return executed
 
     @abstractmethod
     def next_instruction(self): pass
@@ -0,0 +1,150 @@
+"""
+Step debugger for interpreters
+
+The debugger drives an interpreter one step at a time and checks its
+breakpoints and watches in between, so the interpreter's own run loop
+stays untouched when no debugger is used.
+"""
+
+from collections import namedtuple
+
+# Why the debugger stopped: "breakpoint", "name" (a breakpoint by
+# instruction name), "watch", "step" (the requested number of steps has
+# been executed) or "finished". detail is the breakpoint's instruction
+# index or name, or the watch's condition.
+Stop = namedtuple("Stop", ["reason", "instruction_pointer", "detail"])
+
+class Debugger:
+    """
+    Breakpoints, watches and stepping for an interpreter
+    """
+
+    def __init__(self, interpreter):
+        """
+        Arguments:
+            interpreter -- the AbstractInterpreter to debug
+        """
+        self.interpreter = interpreter
+        # Instruction indices and names to stop before
+        self.breakpoints = set()
+        self.name_breakpoints = set()
+        # Conditions with the result of their last check
+        self._watches = {}
+        # Instruction pointer and steps of the interpreter at the last stop
+        self._last_stop = None
+
+    def add_breakpoint(self, index):
+        """Stop before the instruction at index is executed"""
+        self.breakpoints.add(index)
+
+    def remove_breakpoint(self, index):
+        self.breakpoints.discard(index)
+
+    def add_name_breakpoint(self, name):
+        """
+        Stop before an instruction with the given name is executed, such as
+        a station in Mornington Crescent, see instruction_name
+        """
+        self.name_breakpoints.add(name)
+
+    def remove_name_breakpoint(self, name):
+        self.name_breakpoints.discard(name)
+
+    def add_watch(self, condition):
+        """
+        Stop after a step that made a condition true
+
+        Arguments:
+            condition -- function of the interpreter, for example
+                         lambda interpreter: interpreter.accumulator == 0
+        """
+        self._watches[condition] = bool(condition(self.interpreter))
+
+    def remove_watch(self, condition):
+        self._watches.pop(condition, None)
+
+    def step(self, count = 1):
+        """
+        Execute count instructions, ignoring breakpoints and watches
+
+        Returns a Stop.
+        """
+        interpreter = self.interpreter
+        for _ in range(count):
+            if interpreter.has_execution_finished():
+                return self._stop("finished")
+            self._execute_step()
+        self._update_watches()
+        if interpreter.has_execution_finished():
+            return self._stop("finished")
+        return self._stop("step")
+
+    def cont(self, max_steps = None):
+        """
+        Execute instructions until a breakpoint or watch stops the program,
+        it finishes or max_steps instructions have been executed
+
+        Breakpoints aren't checked before the instruction the debugger
+        last stopped at, if the interpreter hasn't moved since, so
+        continuing from a breakpoint moves on.
+
+        Returns a Stop.
+        """
+        interpreter = self.interpreter
+        executed = 0
+        resumed = self._last_stop == (interpreter.instruction_pointer, interpreter.steps)
+        while not(interpreter.has_execution_finished()):
+            if executed == max_steps:
+                return self._stop("step")
+            if executed or not(resumed):
+                stop = self._check_breakpoints()
+                if stop:
+                    return stop
+            self._execute_step()
+            executed += 1
+            stop = self._check_watches()
+            if stop:
+                return stop
+        return self._stop("finished")
+
+    def run_to(self, index, max_steps = None):
+        """Continue until the instruction at index is reached, see cont"""
+        added = index not in self.breakpoints
+        self.breakpoints.add(index)
+        try:
+            return self.cont(max_steps)
+        finally:
+            if added:
+                self.breakpoints.discard(index)
+
+    def _execute_step(self):
+        interpreter = self.interpreter
+        interpreter.steps += interpreter.execute(1)
+
+    def _check_breakpoints(self):
+        ip = self.interpreter.instruction_pointer
+        if ip in self.breakpoints:
+            return self._stop("breakpoint", ip)
+        if self.name_breakpoints:
+            name = self.interpreter.instruction_name(ip)
+            if name in self.name_breakpoints:
+                return self._stop("name", name)
+
+    def _check_watches(self):
+        for condition, was_true in self._watches.items():
+            is_true = bool(condition(self.interpreter))
+            self._watches[condition] = is_true
+            if is_true and not(was_true):
+                self._update_watches()
+                return self._stop("watch", condition)
+
+    def _update_watches(self):
+        for condition in self._watches:
+            self._watches[condition] = bool(condition(self.interpreter))
+
+    def _stop(self, reason, detail = None):
+        # Show the output produced so far whenever the program pauses
+        interpreter = self.interpreter
+        interpreter.flush()
+        self._last_stop = (interpreter.instruction_pointer, interpreter.steps)
+        return Stop(reason, interpreter.instruction_pointer, detail)
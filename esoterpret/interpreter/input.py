@@ -0,0 +1,127 @@
+"""
+Input readers interpreters read their input from
+"""
+
+import io
+import mmap
+import os
+
+class InputReader:
+    """
+    Reads a stream in large chunks and hands it out as UTF-8 encoded bytes,
+    characters or lines
+
+    Text streams are encoded as UTF-8, binary streams are passed on as they
+    are. Streams with an underlying binary buffer, such as sys.stdin, are
+    read through it, only waiting for input that is already available.
+    """
+
+    def __init__(self, stream, chunk_size = 65536):
+        """
+        Arguments:
+            stream -- file-like object to read from
+            chunk_size -- number of bytes or characters read at once
+        """
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self._buffer = b""
+        self._position = 0
+
+    def isatty(self):
+        return self.stream is not None and self.stream.isatty()
+
+    def read_byte(self):
+        """Read the next byte as an integer, None at the end of input"""
+        if self._position >= len(self._buffer) and not(self._fill()):
+            return None
+        value = self._buffer[self._position]
+        self._position += 1
+        return value
+
+    def read_char(self):
+        """Read the next character, an empty string at the end of input"""
+        if self._position >= len(self._buffer) and not(self._fill()):
+            return ""
+        lead = self._buffer[self._position]
+        if lead < 0x80:
+            self._position += 1
+            return chr(lead)
+
+        length = 2 if lead < 0xe0 else 3 if lead < 0xf0 else 4
+        while len(self._buffer) - self._position < length and self._fill():
+            pass
+        try:
+            character = bytes(self._buffer[self._position:self._position + length]).decode("utf-8")
+        except UnicodeDecodeError:
+            # Skip a single byte of an invalid sequence
+            self._position += 1
+            return "\ufffd"
+        self._position += length
+        return character
+
+    def readline(self):
+        """Read up to and including the next newline, an empty string at the end of input"""
+        end = self._buffer.find(b"\n", self._position)
+        while end < 0:
+            searched = len(self._buffer) - self._position
+            if not(self._fill()):
+                end = len(self._buffer) - 1
+                break
+            end = self._buffer.find(b"\n", self._position + searched)
+        line = bytes(self._buffer[self._position:end + 1])
+        self._position = end + 1
+        return line.decode("utf-8", "replace")
+
+    def _fill(self):
+        """Append the next chunk to the buffer, returns False at the end of input"""
+        if self.stream is None:
+            return False
+        chunk = self._read_chunk()
+        if not(chunk):
+            return False
+        self._buffer = self._buffer[self._position:] + chunk
+        self._position = 0
+        return True
+
+    def _read_chunk(self):
+        stream = self.stream
+        buffer = getattr(stream, "buffer", None)
+        if buffer is not None and hasattr(buffer, "read1"):
+            return buffer.read1(self.chunk_size)
+        if isinstance(stream, io.TextIOBase):
+            if stream.isatty():
+                # Reading a whole chunk would wait for the end of input
+                return stream.readline().encode("utf-8", "surrogateescape")
+            return stream.read(self.chunk_size).encode("utf-8", "surrogateescape")
+        if hasattr(stream, "read1"):
+            return stream.read1(self.chunk_size)
+        chunk = stream.read(self.chunk_size)
+        return chunk.encode("utf-8", "surrogateescape") if isinstance(chunk, str) else chunk
+
+class MappedReader(InputReader):
+    """
+    Reads a file by mapping it into memory, without copying it
+    """
+
+    def __init__(self, path):
+        """
+        Arguments:
+            path -- the file to read
+        """
+        super().__init__(None)
+        with open(path, "rb") as input_file:
+            # Empty files can't be mapped
+            if os.fstat(input_file.fileno()).st_size:
+                self._buffer = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def isatty(self):
+        return False
+
+def open_input(path):
+    """
+    Open a file as input, mapped into memory if it is a regular file and
+    read in chunks otherwise, e.g. for pipes
+    """
+    if os.path.isfile(path):
+        return MappedReader(path)
+    return InputReader(open(path, "rb"))
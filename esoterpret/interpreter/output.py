@@ -0,0 +1,95 @@
+"""
+Output sinks interpreters write their output to
+"""
+
+import sys
+from abc import ABCMeta, abstractmethod
+from collections import deque
+
+class OutputSink(metaclass=ABCMeta):
+    """
+    Base class of all output sinks
+    """
+
+    @abstractmethod
+    def write(self, text): pass
+
+    def flush(self):
+        pass
+
+class BufferedSink(OutputSink):
+    """
+    Collects output and writes it to a stream in large chunks
+    """
+
+    def __init__(self, stream = None, threshold = 8192):
+        """
+        Arguments:
+            stream -- file-like object to write to, None for the current sys.stdout
+            threshold -- number of buffered characters that triggers a flush
+        """
+        self.stream = stream
+        self.threshold = threshold
+        self._buffer = []
+        self._size = 0
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size >= self.threshold:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            stream = self.stream or sys.stdout
+            stream.write("".join(self._buffer))
+            stream.flush()
+            self._buffer = []
+            self._size = 0
+
+class CaptureSink(OutputSink):
+    """
+    Keeps all output in memory
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, text):
+        self._chunks.append(text)
+
+    def getvalue(self):
+        return "".join(self._chunks)
+
+class RingSink(OutputSink):
+    """
+    Keeps only the most recent output in memory
+    """
+
+    def __init__(self, limit = 65536):
+        """
+        Arguments:
+            limit -- number of characters to keep
+        """
+        self.limit = limit
+        self.dropped = 0
+        self._chunks = deque()
+        self._size = 0
+
+    def write(self, text):
+        self._chunks.append(text)
+        self._size += len(text)
+        # Drop whole chunks as long as enough output remains
+        while self._size - len(self._chunks[0]) >= self.limit:
+            chunk = self._chunks.popleft()
+            self._size -= len(chunk)
+            self.dropped += len(chunk)
+
+    def getvalue(self):
+        value = "".join(self._chunks)
+        if len(value) > self.limit:
+            self.dropped += len(value) - self.limit
+            value = value[-self.limit:]
+            self._chunks = deque([value])
+            self._size = len(value)
+        return value
@@ -4,21 +4,45 @@ import os
 import sys
 
 path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+modules_directory = os.path.join(path, "modules")
 
-class Language:
+# Keys every config.json has to define
+required_keys = ("name", "baseclass", "basefile")
+
+def load_config(name):
+    """
+    Read and validate the config.json of a language module
 
-    def __init__(self, name):
-        # Load config
-        content = None
-        directory = os.path.join(path, "modules", name)
-        with open(os.path.join(directory, "config.json")) as config_file:
-           config = json.loads(config_file.read())
+    Arguments:
+        name -- the module's directory name
+    """
+    with open(os.path.join(modules_directory, name, "config.json")) as config_file:
+        config = json.loads(config_file.read())
+    for key in required_keys:
+        if key not in config:
+            raise ValueError("config.json of %s is missing \"%s\"" % (name, key))
+    return config
+
+class Language:
 
-        self.config = config
+    def __init__(self, name, config = None):
+        """
+        Arguments:
+            name -- the module's directory name
+            config -- the module's config if already known, read from
+                      config.json otherwise
+        """
+        self.name = name
+        self.config = config or load_config(name)
+        self._interpreter_class = None
 
-        # Import the module
-        interpreter_file = os.path.join(directory, config["basefile"])
-        spec = importlib.util.spec_from_file_location(name, interpreter_file)
-        self._module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(self._module)
-        self.interpreter_class = getattr(self._module, config["baseclass"])
+    @property
+    def interpreter_class(self):
+        """The interpreter class, its module is imported on first access"""
+        if self._interpreter_class is None:
+            interpreter_file = os.path.join(modules_directory, self.name, self.config["basefile"])
+            spec = importlib.util.spec_from_file_location(self.name, interpreter_file)
+            self._module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(self._module)
+            self._interpreter_class = getattr(self._module, self.config["baseclass"])
+        return self._interpreter_class
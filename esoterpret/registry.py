@@ -0,0 +1,113 @@
+import json
+import os
+
+from esoterpret.cache import cache_directory
+from esoterpret.language import Language, load_config, modules_directory
+
+class LanguageRegistry:
+    """
+    Discovers the installed language modules
+
+    Discovery only reads config.json files, interpreters are imported when
+    a language is run. Configs are kept in an on-disk index and only read
+    again when a config.json has been modified.
+    """
+
+    def __init__(self, directory = modules_directory, index_file = None):
+        """
+        Arguments:
+            directory -- the directory holding the language modules
+            index_file -- where to keep the index, None for the cache directory
+        """
+        self.directory = directory
+        self.index_file = index_file or os.path.join(cache_directory(), "languages.json")
+        self._languages = None
+        self._extensions = None
+        self._loaded = {}
+        # Modules that could not be loaded, as (name, reason) tuples
+        self.problems = []
+
+    def get(self, name):
+        """
+        Find a language by its module name, without scanning all modules
+
+        Raises FileNotFoundError for unknown languages, including names that
+        aren't a plain directory name and could point outside the modules.
+        """
+        if (not(name) or name in (os.curdir, os.pardir) or os.sep in name
+                or (os.altsep and os.altsep in name)):
+            raise FileNotFoundError("not a language module name: %r" % name)
+        if self._languages is not None and name in self._languages:
+            return self._languages[name]
+        if name not in self._loaded:
+            self._loaded[name] = Language(name)
+        return self._loaded[name]
+
+    def for_file(self, filename):
+        """Find the language of a script by its file extension, or None"""
+        return self.for_extension(os.path.splitext(filename)[1])
+
+    def for_extension(self, extension):
+        """
+        Find the language using a file extension such as ".bf", or None
+
+        If several languages claim an extension, the first by module name wins.
+        """
+        if self._extensions is None:
+            self._extensions = {}
+            for language in self.languages():
+                claimed = language.config.get("extension")
+                if claimed:
+                    self._extensions.setdefault(claimed.lower(), language)
+        return self._extensions.get(extension.lower())
+
+    def languages(self):
+        """All valid languages, sorted by module name"""
+        if self._languages is None:
+            self._languages = self._discover()
+        return [self._languages[name] for name in sorted(self._languages)]
+
+    def _discover(self):
+        index = self._read_index()
+        entries = {}
+        languages = {}
+        for entry in os.scandir(self.directory):
+            if not(entry.is_dir()) or entry.name.startswith((".", "__")):
+                continue
+            try:
+                mtime = os.stat(os.path.join(entry.path, "config.json")).st_mtime_ns
+                cached = index.get(entry.name)
+                if cached and cached["mtime"] == mtime:
+                    config = cached["config"]
+                else:
+                    config = load_config(entry.name)
+            except (OSError, ValueError) as error:
+                self.problems.append((entry.name, str(error)))
+                continue
+            entries[entry.name] = {"mtime": mtime, "config": config}
+            languages[entry.name] = Language(entry.name, config)
+
+        if entries != index:
+            self._write_index(entries)
+        return languages
+
+    def _read_index(self):
+        try:
+            with open(self.index_file) as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return {}
+        if index.get("directory") != self.directory:
+            return {}
+        return index.get("modules", {})
+
+    def _write_index(self, entries):
+        # The index is only a cache, failing to write it is not an error
+        try:
+            os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+            temporary = self.index_file + ".%d.tmp" % os.getpid()
+            with open(temporary, "w") as index_file:
+                json.dump({"directory": self.directory, "modules": entries}, index_file)
+            os.replace(temporary, self.index_file)
+        except OSError:
+            pass
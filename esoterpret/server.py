@@ -0,0 +1,415 @@
+"""
+Resident evaluation server
+
+Keeps languages loaded in a pool of warm worker processes and accepts jobs
+as JSON-RPC 2.0 requests, one JSON object per line, over a Unix socket or
+stdin/stdout:
+
+    {"jsonrpc": "2.0", "id": 1, "method": "run",
+     "params": {"language": "brainfuck", "code": ",[.,]", "stdin": "hi",
+                "limits": {"max_steps": 100000, "max_time": 1}}}
+
+Requests are handled concurrently and every response is written as soon
+as its job completes, so responses can arrive in a different order than
+the requests; match them by "id".
+
+Methods:
+    run -- run "code" in "language" with optional "stdin" text,
+           interpreter "options" and "limits" ("max_steps", "max_time" in
+           seconds, "max_output" in bytes). Only a few harmless
+           options can be set, see _client_options, and limits can only
+           lower the server's own. The result is that of a batch job, see run_job,
+           with the status "killed" if the worker had to be killed.
+    languages -- the names of the installed languages
+
+Every worker runs one job at a time. Jobs are held to a time limit, a
+minute unless the server is given another one, and jobs that still
+haven't finished after twice that time plus a second, e.g. stuck in a
+single huge step, get their worker killed and replaced. So do the jobs of
+a client that disconnects before they finish.
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import stat
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from esoterpret.batch import run_job, worker_registry
+from esoterpret.registry import LanguageRegistry
+
+# Longest request line accepted, code and stdin included
+_line_limit = 2**24
+
+# JSON-RPC error codes
+_parse_error = -32700
+_invalid_request = -32600
+_method_not_found = -32601
+_invalid_params = -32602
+
+# Job limits and the interpreter options they map to
+_limit_options = {"max_steps": "step_limit", "max_time": "time_limit", "max_output": "output_limit"}
+
+# Interpreter options clients may set, with their types. Anything else,
+# such as trace files, profiles or lifting the memory caps, is only for
+# whoever runs the server.
+_client_options = {
+    "brainfuck": {"backend": str, "tape_size": int, "overflow": str, "eof": int},
+    "morningtoncrescent": {"backend": str, "optimize": bool},
+}
+_max_tape_size = 2**24
+
+# Time limit in seconds of jobs on a server started without one, so that
+# a program looping forever can't hold on to a worker
+_default_max_time = 60
+
+def _worker_main(connection, languages):
+    """Run jobs received over connection until it is closed"""
+    # The server handles interrupts and shuts the workers down itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    registry = worker_registry()
+    for name in languages:
+        registry.get(name).interpreter_class
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        connection.send(run_job(job))
+
+class Worker:
+    """
+    A worker process with the connection jobs are sent over
+    """
+
+    def __init__(self, languages):
+        """
+        Arguments:
+            languages -- names of the languages to load right away
+        """
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_main, args=(child, languages),
+                                               daemon=True)
+        self.process.start()
+        child.close()
+
+    def run(self, job):
+        """Run a job and wait for its result, raises EOFError if the worker died"""
+        self.connection.send(job)
+        return self.connection.recv()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+    def stop(self):
+        self.connection.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.kill()
+
+class WorkerPool:
+    """
+    Warm worker processes running one job at a time each
+    """
+
+    def __init__(self, workers = None, languages = ()):
+        """
+        Arguments:
+            workers -- number of worker processes, None for one per CPU
+            languages -- names of the languages every worker loads on start
+        """
+        self.size = workers or os.cpu_count() or 1
+        self.languages = list(languages)
+        self._idle = None
+        self._workers = []
+        # Threads waiting for the workers' results
+        self._threads = ThreadPoolExecutor(max_workers=self.size)
+
+    def start(self):
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            self._add_worker()
+
+    def stop(self):
+        for worker in self._workers:
+            worker.stop()
+        self._workers = []
+        self._threads.shutdown()
+
+    async def run(self, job, deadline = None):
+        """
+        Run a job on the next idle worker
+
+        Arguments:
+            job -- the job, see run_job
+            deadline -- seconds after which the worker is killed, None to
+                        wait for the job however long it takes
+
+        If cancelled while the job runs, the worker is killed and replaced,
+        there's no telling when it would be done with the job.
+        """
+        worker = await self._idle.get()
+        loop = asyncio.get_running_loop()
+        try:
+            result = await asyncio.wait_for(
+                loop.run_in_executor(self._threads, worker.run, job), deadline)
+        except asyncio.CancelledError:
+            self._replace(worker)
+            raise
+        except (asyncio.TimeoutError, EOFError, OSError) as error:
+            self._replace(worker)
+            if isinstance(error, asyncio.TimeoutError):
+                message = "worker killed after %s seconds" % deadline
+            else:
+                # Died on its own, e.g. killed for running out of memory
+                message = "worker died (exit code %s)" % worker.process.exitcode
+            return {"script": None, "language": job.get("language"), "status": "killed",
+                    "stdout": "", "steps": 0, "time": 0.0, "error": message}
+        self._idle.put_nowait(worker)
+        return result
+
+    def _replace(self, worker):
+        worker.kill()
+        self._workers.remove(worker)
+        self._add_worker()
+
+    def _add_worker(self):
+        worker = Worker(self.languages)
+        self._workers.append(worker)
+        self._idle.put_nowait(worker)
+
+class _StdioStreams:
+    """
+    stdin and stdout as the reader and writer of a connection
+
+    They can be files as well as pipes, which asyncio's pipe transports
+    don't accept, so stdin is read by a thread and lines are written right
+    away. The thread is a daemon reading the raw file descriptor, so that a
+    server waiting for input can still exit.
+    """
+
+    def __init__(self):
+        loop = asyncio.get_running_loop()
+        self._reader = asyncio.StreamReader(limit=_line_limit)
+
+        def read():
+            while True:
+                try:
+                    chunk = os.read(sys.stdin.fileno(), 65536)
+                except OSError:
+                    chunk = b""
+                try:
+                    if not(chunk):
+                        loop.call_soon_threadsafe(self._reader.feed_eof)
+                        return
+                    loop.call_soon_threadsafe(self._reader.feed_data, chunk)
+                except RuntimeError:
+                    # The server has shut down in the meantime
+                    return
+
+        threading.Thread(target=read, daemon=True).start()
+
+    async def readline(self):
+        return await self._reader.readline()
+
+    def write(self, data):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+class Server:
+    """
+    JSON-RPC front end handing jobs to a WorkerPool
+    """
+
+    def __init__(self, pool, limits = None):
+        """
+        Arguments:
+            pool -- the WorkerPool running the jobs
+            limits -- dict with the "max_steps", "max_time" and
+                      "max_output" every job is held to, if any, "max_time"
+                      defaults to _default_max_time
+        """
+        self.pool = pool
+        self.limits = dict(limits or {})
+        self.limits.setdefault("max_time", _default_max_time)
+        self._registry = LanguageRegistry()
+
+    async def serve_unix(self, path):
+        """Accept connections on a Unix socket until cancelled"""
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            # Left behind by a server that didn't shut down cleanly
+            os.unlink(path)
+        server = await asyncio.start_unix_server(self.handle, path, limit=_line_limit)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    async def serve_stdio(self):
+        """Serve requests from stdin on stdout until stdin is closed"""
+        streams = _StdioStreams()
+        await self.handle(streams, streams)
+
+    async def handle(self, reader, writer):
+        """Answer the requests of one connection"""
+        tasks = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    await self._send(writer, self._error(None, _invalid_request, "request too long"))
+                    break
+                except ConnectionError:
+                    # Gone without waiting for its responses, its jobs are
+                    # cancelled below
+                    return
+                if not(line):
+                    break
+                if line.strip():
+                    task = asyncio.ensure_future(self._answer(line, writer))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _answer(self, line, writer):
+        response = await self.respond(line)
+        if response is not None:
+            try:
+                await self._send(writer, response)
+            except ConnectionError:
+                # The client is gone, nobody is waiting for the response
+                pass
+
+    async def respond(self, line):
+        """
+        Handle a single request line
+
+        Returns the response as a dict, None for notifications.
+        """
+        try:
+            request = json.loads(line)
+        except ValueError as error:
+            return self._error(None, _parse_error, str(error))
+        if not(isinstance(request, dict)) or not(isinstance(request.get("method"), str)):
+            return self._error(None, _invalid_request, "a request needs a \"method\"")
+        request_id = request.get("id")
+        params = request.get("params", {})
+        if not(isinstance(params, dict)):
+            return self._error(request_id, _invalid_params, "params have to be an object")
+
+        if request["method"] == "run":
+            try:
+                job, deadline = self._job(params)
+            except ValueError as error:
+                return self._error(request_id, _invalid_params, str(error))
+            result = await self.pool.run(job, deadline)
+            del result["script"]
+        elif request["method"] == "languages":
+            result = [language.name for language in self._registry.languages()]
+        else:
+            return self._error(request_id, _method_not_found, "unknown method " + request["method"])
+
+        if "id" not in request:
+            return None
+        return {"jsonrpc": "2.0", "id": request_id, "result": result}
+
+    def _job(self, params):
+        """The batch job and kill deadline of run's params"""
+        for key, kind in (("language", str), ("code", str), ("stdin", str),
+                          ("options", dict), ("limits", dict)):
+            if key in params and not(isinstance(params[key], kind)):
+                raise ValueError("\"%s\" has the wrong type" % key)
+        if "language" not in params or "code" not in params:
+            raise ValueError("run needs a \"language\" and \"code\"")
+        if params["language"] not in self._language_names():
+            raise ValueError("unknown language " + params["language"])
+
+        options = {}
+        allowed = _client_options.get(params["language"], {})
+        for key, value in params.get("options", {}).items():
+            if key not in allowed:
+                raise ValueError("option %s can't be set by clients" % key)
+            if type(value) is not allowed[key]:
+                raise ValueError("option %s has to be of type %s" % (key, allowed[key].__name__))
+            options[key] = value
+        if not(0 < options.get("tape_size", 1) <= _max_tape_size):
+            raise ValueError("tape_size has to be between 1 and %d" % _max_tape_size)
+
+        limits = dict(self.limits)
+        for key, limit in params.get("limits", {}).items():
+            if key not in _limit_options:
+                raise ValueError("unknown limit " + key)
+            if not(isinstance(limit, (int, float))) or isinstance(limit, bool):
+                raise ValueError("limit %s has to be a number" % key)
+            limits[key] = min(limit, limits.get(key, limit))
+        for key, limit in limits.items():
+            options[_limit_options[key]] = limit
+
+        deadline = 2 * limits["max_time"] + 1
+        return {"language": params["language"], "code": params["code"],
+                "stdin": params.get("stdin", ""), "options": options}, deadline
+
+    def _language_names(self):
+        return set(language.name for language in self._registry.languages())
+
+    @staticmethod
+    def _error(request_id, code, message):
+        return {"jsonrpc": "2.0", "id": request_id, "error": {"code": code, "message": message}}
+
+    @staticmethod
+    async def _send(writer, response):
+        writer.write((json.dumps(response) + "\n").encode("utf-8"))
+        await writer.drain()
+
+def serve(socket_path = None, workers = None, limits = None, languages = None):
+    """
+    Run the server until interrupted or terminated, or until stdin is closed
+
+    Arguments:
+        socket_path -- the Unix socket to listen on, None for stdin/stdout
+        workers -- number of worker processes, None for one per CPU
+        limits -- dict with the "max_steps", "max_time" and "max_output"
+                  every job is held to, if any, see Server
+        languages -- names of the languages workers load on start, None
+                     for all installed ones
+    """
+    if languages is None:
+        languages = [language.name for language in LanguageRegistry().languages()]
+    pool = WorkerPool(workers, languages)
+    server = Server(pool, limits)
+
+    async def main():
+        # Shut down cleanly when terminated, like when interrupted
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        pool.start()
+        if socket_path is None:
+            await server.serve_stdio()
+        else:
+            await server.serve_unix(socket_path)
+
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        pool.stop()
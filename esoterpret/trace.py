@@ -0,0 +1,198 @@
+"""
+Execution traces
+
+A trace holds one record per executed step: the "step" number, the
+instruction pointer "ip", the source "line", the "destination" of the
+step and the type and size of the accumulator and of the destination's
+value before the step ("acc_type", "acc_size", "value_type",
+"value_size"). Sizes are bit lengths for integers and lengths for strings.
+
+Traces are written as JSON lines if the file name ends in .jsonl, and in
+a compact binary format otherwise. The binary format starts with the magic
+bytes, followed by records each starting with a kind byte: a name record
+assigns an id to a destination on its first use, a step record holds the
+fields above with the destination's id.
+
+To read a trace, run this module:
+
+    python -m esoterpret.trace trace.bin --ip 10:20 --last 50
+"""
+
+import argparse
+import json
+import struct
+from collections import deque
+
+_magic = b"ESOTRACE\x01"
+_kind = struct.Struct("<B")
+_name = struct.Struct("<HH")
+_step = struct.Struct("<QIIHBQBQ")
+_name_record = 0
+_step_record = 1
+_types = ("int", "str", "other")
+
+def value_type(value):
+    """Type and size of a value as stored in trace records"""
+    if isinstance(value, int):
+        return "int", abs(value).bit_length()
+    elif isinstance(value, str):
+        return "str", len(value)
+    return "other", 0
+
+def parse_range(text):
+    """
+    Parse an instruction pointer range such as "10:20" into a tuple
+
+    Either end can be left out, the end is exclusive.
+    """
+    first, separator, last = text.partition(":")
+    if not(separator):
+        raise ValueError("a range has to look like first:last, not " + text)
+    return (int(first) if first else 0, int(last) if last else None)
+
+class Tracer:
+    """
+    Writes the sampled steps of a program to a trace file
+    """
+
+    def __init__(self, path, every = 1, ip_range = None, last = 0):
+        """
+        Arguments:
+            path -- the trace file, JSON lines if it ends in .jsonl, else binary
+            every -- only trace every nth step
+            ip_range -- (first, last) instruction pointers to trace, last
+                        exclusive and None for no end, None to trace all
+            last -- keep only the last this many records in memory and write
+                    them when the program fails, 0 to write every record
+        """
+        if every < 1:
+            raise ValueError("every has to be positive")
+        self.every = every
+        self.ip_range = ip_range
+        self._binary = not(path.endswith(".jsonl"))
+        self._file = open(path, "wb" if self._binary else "w")
+        if self._binary:
+            self._file.write(_magic)
+        self._names = {}
+        self._ring = deque(maxlen=last) if last else None
+
+    def wants(self, step, ip):
+        """Whether the step at the given instruction pointer is sampled"""
+        if step % self.every:
+            return False
+        if self.ip_range is not None:
+            first, last = self.ip_range
+            return ip >= first and (last is None or ip < last)
+        return True
+
+    def record(self, step, ip, line, destination, accumulator, value):
+        """
+        Trace a step, which has to be sampled according to wants
+
+        Arguments:
+            step -- number of the step, counting from 0
+            ip -- the instruction pointer
+            line -- the source line of the instruction
+            destination -- where the step goes
+            accumulator -- the accumulator before the step
+            value -- the destination's value before the step
+        """
+        record = (step, ip, line, destination) + value_type(accumulator) + value_type(value)
+        if self._ring is not None:
+            self._ring.append(record)
+        else:
+            self._write(record)
+
+    def fail(self):
+        """Write the records kept in memory, the program has failed"""
+        if self._ring is not None:
+            for record in self._ring:
+                self._write(record)
+            self._ring.clear()
+        self.close()
+
+    def close(self):
+        if not(self._file.closed):
+            self._file.close()
+
+    def _write(self, record):
+        step, ip, line, destination, acc_type, acc_size, value_type, value_size = record
+        if not(self._binary):
+            self._file.write(json.dumps({"step": step, "ip": ip, "line": line,
+                                         "destination": destination,
+                                         "acc_type": acc_type, "acc_size": acc_size,
+                                         "value_type": value_type, "value_size": value_size}) + "\n")
+            return
+        name = self._names.get(destination)
+        if name is None:
+            name = self._names[destination] = len(self._names)
+            encoded = destination.encode("utf-8")
+            self._file.write(_kind.pack(_name_record) + _name.pack(name, len(encoded)) + encoded)
+        self._file.write(_kind.pack(_step_record) + _step.pack(
+            step, ip, line, name, _types.index(acc_type), acc_size,
+            _types.index(value_type), value_size))
+
+def read_trace(path):
+    """Yield the records of a trace file as dicts"""
+    with open(path, "rb") as trace:
+        if trace.read(len(_magic)) != _magic:
+            trace.seek(0)
+            for line in trace:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        names = {}
+        while True:
+            kind = trace.read(_kind.size)
+            if not(kind):
+                return
+            if _kind.unpack(kind)[0] == _name_record:
+                name, length = _name.unpack(trace.read(_name.size))
+                names[name] = trace.read(length).decode("utf-8")
+                continue
+            data = trace.read(_step.size)
+            if len(data) < _step.size:
+                raise ValueError("%s: truncated trace" % path)
+            step, ip, line, name, acc_type, acc_size, value_type, value_size = _step.unpack(data)
+            yield {"step": step, "ip": ip, "line": line, "destination": names[name],
+                   "acc_type": _types[acc_type], "acc_size": acc_size,
+                   "value_type": _types[value_type], "value_size": value_size}
+
+def format_record(record):
+    """Describe a trace record as a line of text"""
+    return "%10d  [%d] line %d: %s  acc %s(%d)  value %s(%d)" % (
+        record["step"], record["ip"], record["line"], record["destination"],
+        record["acc_type"], record["acc_size"], record["value_type"], record["value_size"])
+
+def main(arguments = None):
+    parser = argparse.ArgumentParser(description="Replay and filter an execution trace")
+    parser.add_argument("trace", help="the trace file")
+    parser.add_argument("--ip", type=parse_range, help="only steps in this instruction pointer range, e.g. 10:20")
+    parser.add_argument("--line", type=int, help="only steps of this source line")
+    parser.add_argument("--destination", help="only steps going to this destination")
+    parser.add_argument("--every", type=int, default=1, help="only every nth of the remaining steps")
+    parser.add_argument("--last", type=int, help="only the last this many of the remaining steps")
+    parser.add_argument("--jsonl", action="store_true", help="print records as JSON lines")
+    arguments = parser.parse_args(arguments)
+
+    def selected():
+        for record in read_trace(arguments.trace):
+            if arguments.ip is not None:
+                first, last = arguments.ip
+                if record["ip"] < first or (last is not None and record["ip"] >= last):
+                    continue
+            if arguments.line is not None and record["line"] != arguments.line:
+                continue
+            if arguments.destination is not None and record["destination"] != arguments.destination:
+                continue
+            yield record
+
+    records = (record for index, record in enumerate(selected()) if index % arguments.every == 0)
+    if arguments.last:
+        records = deque(records, maxlen=arguments.last)
+    for record in records:
+        print(json.dumps(record) if arguments.jsonl else format_record(record))
+
+if __name__ == "__main__":
+    main()
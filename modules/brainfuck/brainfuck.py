@@ -6,11 +6,438 @@ More information: http://esolangs.org/wiki/Brainfuck
 
 """
 
+import codecs
+import hashlib
+import marshal
+from esoterpret.cache import cached, source_version
+from esoterpret.interpreter.baseclass import AbstractInterpreter, BudgetExceeded
 
-from esoterpret.interpreter.baseclass import AbstractInterpreter
-from collections import defaultdict
-import sys, re
+# Operations of the compiled program. Every instruction is a tuple of an
+# operation and its argument.
+ADD      = 0  # add argument to the current cell
+MOVE     = 1  # move the tape pointer by argument cells
+OPEN     = 2  # "[", argument is the index after the matching CLOSE
+CLOSE    = 3  # "]", argument is the index after the matching OPEN
+OUTPUT   = 4  # write the current cell argument times
+INPUT    = 5  # read argument characters into the current cell
+CLEAR    = 6  # "[-]", set the current cell to zero
+MULTIPLY = 7  # "[->++>+++<<]", argument is ((offset, factor), ...), lowest offset
+SCAN     = 8  # "[>]", move by argument cells until a zero cell is found
+
+# Names of the operations, indexed by operation
+operation_names = ("add", "move", "open", "close", "output", "input", "clear", "multiply", "scan")
+
+# Version of this interpreter, for the program cache
+_version = source_version(__file__)
+
+_folded = {"+": ADD, "-": ADD, ">": MOVE, "<": MOVE, ".": OUTPUT, ",": INPUT}
+_amount = {"+": 1, "-": -1, ">": 1, "<": -1, ".": 1, ",": 1}
+
+def compile_program(code, wrap = True):
+    """
+    Compile Brainfuck source code into a list of instructions
+
+    Runs of "+-", "<>", "." and "," are folded into single instructions,
+    brackets get their jump targets and clear, multiply and scan loops are
+    replaced by a single instruction. Runs mixing "<" and ">", or "+" and
+    "-" without wrapping, are only folded while they go one way, so that a
+    pointer or cell leaving its range in the middle of a run is still
+    caught.
+
+    Arguments:
+        code -- the code to compile as a string
+        wrap -- whether cell values wrap around, which allows loops counting
+                their cell up to be turned into multiplications
+    """
+    program = []
+    opened = []
+    for position, character in enumerate(code):
+        if character in _folded:
+            op = _folded[character]
+            amount = _amount[character]
+            # Fold into the previous instruction. ADD and MOVE runs that
+            # cancel out are dropped entirely.
+            if (program and program[-1][0] == op
+                    and ((op == ADD and wrap) or (program[-1][1] > 0) == (amount > 0))):
+                amount += program.pop()[1]
+                if amount == 0 and op in (ADD, MOVE):
+                    continue
+            program.append((op, amount))
+        elif character == "[":
+            opened.append((len(program), position))
+            program.append((OPEN, None))
+        elif character == "]":
+            if not(opened):
+                raise RuntimeError("Unmatched ] at position " + str(position) + ".")
+            start, _ = opened.pop()
+            idiom = _loop_idiom(program[start + 1:], wrap)
+            if idiom is not None:
+                del program[start:]
+                program.append(idiom)
+            else:
+                program[start] = (OPEN, len(program) + 1)
+                program.append((CLOSE, start + 1))
+    if opened:
+        raise RuntimeError("Unmatched [ at position " + str(opened[-1][1]) + ".")
+    return program
+
+def load_program(code, wrap = True):
+    """
+    Compile Brainfuck source code like compile_program, loading the result
+    from the program cache if the same code was compiled before
+    """
+    return cached("program", "brainfuck", _version, "%s:%s" % (wrap, code),
+                  lambda: compile_program(code, wrap))
+
+def _loop_idiom(body, wrap):
+    """
+    Find a single instruction doing the same as a loop, or return None
+
+    Arguments:
+        body -- the instructions inside the loop
+        wrap -- whether cell values wrap around
+    """
+    if len(body) == 1 and body[0][0] == MOVE:
+        return (SCAN, body[0][1])
+    if not(body) or any(op not in (ADD, MOVE) for op, _ in body):
+        return None
+
+    offset = 0
+    changes = {}
+    for op, amount in body:
+        if op == MOVE:
+            offset += amount
+        else:
+            changes[offset] = changes.get(offset, 0) + amount
+    step = changes.pop(0, 0)
+    if offset != 0:
+        return None
+
+    # The loop runs cell times when counting down, and 256 - cell times when
+    # counting up a wrapping cell
+    if step == -1:
+        factors = tuple((offset, factor) for offset, factor in sorted(changes.items()) if factor)
+    elif step == 1 and wrap:
+        factors = tuple((offset, -factor) for offset, factor in sorted(changes.items()) if factor)
+    else:
+        return None
+    if not(factors):
+        return (CLEAR, None)
+    return (MULTIPLY, (factors, min(0, factors[0][0])))
+
+# Python functions generated from Brainfuck programs, keyed by a hash of the
+# Brainfuck source and the overflow mode
+_compiled_functions = {}
+
+def compile_function(code, program, wrap = True):
+    """
+    Translate a compiled program into a Python function, or return None if
+    Python cannot compile it (loops nested too deeply)
+
+    The function takes the tape, the tape pointer and functions to read a
+    cell value and write a cell, runs the whole program and returns the
+    final tape pointer and the number of instructions executed. The write
+    function is also passed the number of instructions executed so far.
+
+    Arguments:
+        code -- the Brainfuck source the program was compiled from
+        program -- list of instructions as returned by compile_program
+        wrap -- whether cell values wrap around
+    """
+    key = hashlib.sha1(("%s:%s" % (wrap, code)).encode("utf-8")).hexdigest()
+    if key not in _compiled_functions:
+        # The code object is cached on disk, marshalled
+        compiled = cached("function", "brainfuck", _version, "%s:%s" % (wrap, code),
+                          lambda: _compile_source(program, wrap))
+        namespace = {"run": None}
+        if compiled[0] is not None:
+            exec(marshal.loads(compiled[0]), namespace)
+        _compiled_functions[key] = namespace["run"]
+    return _compiled_functions[key]
+
+def _compile_source(program, wrap):
+    """The marshalled code object of a program's function in a tuple, None if it can't be compiled"""
+    try:
+        return (marshal.dumps(compile(generate_source(program, wrap), "<brainfuck>", "exec")),)
+    except SyntaxError:
+        return (None,)
+
+def generate_source(program, wrap = True):
+    """
+    Generate the Python source of a function running a compiled program
+
+    Loops become while loops. Every block adds the number of instructions
+    it executed to a step counter, so the count matches the interpreter.
+    Outputs pass the count including the block's instructions up to them,
+    for an output limit to report exactly.
+
+    Arguments:
+        program -- list of instructions as returned by compile_program
+        wrap -- whether cell values wrap around
+    """
+    lines = ["def run(tape, p, read, write):", "    steps = 0"]
+    # Instructions executed per pass through each open block
+    counts = [0]
+    for op, argument in program:
+        indent = "    " * len(counts)
+        if op == OPEN:
+            counts[-1] += 1
+            lines.append(indent + "while tape[p]:")
+            counts.append(0)
+        elif op == CLOSE:
+            lines.append(indent + "steps += %d" % (counts.pop() + 1))
+        elif op == OUTPUT:
+            counts[-1] += 1
+            # The current pass through every open block isn't counted yet
+            lines.append(indent + "write(tape[p], %d, steps + %d)" % (argument, sum(counts)))
+        else:
+            counts[-1] += 1
+            lines.extend(indent + line for line in _statements(op, argument, wrap))
+    lines.append("    steps += %d" % counts[0])
+    lines.append("    return p, steps")
+    return "\n".join(lines) + "\n"
+
+def _statements(op, argument, wrap):
+    """Python statements for a single instruction other than a bracket or output"""
+    if op == ADD:
+        if wrap:
+            return ["tape[p] = (tape[p] %s) & 255" % _signed(argument)]
+        return ["tape[p] += %d" % argument]
+    elif op == MOVE:
+        if argument < 0:
+            return ["p -= %d" % -argument, "if p < 0: raise IndexError"]
+        return ["p += %d" % argument]
+    elif op == CLEAR:
+        return ["tape[p] = 0"]
+    elif op == MULTIPLY:
+        factors, lowest = argument
+        statements = ["if tape[p]:", "    v = tape[p]"]
+        if lowest < 0:
+            statements.append("    if p %d < 0: raise IndexError" % lowest)
+        for offset, factor in factors:
+            cell = "tape[p %s]" % _signed(offset)
+            if wrap:
+                statements.append("    %s = (%s %s) & 255" % (cell, cell, _signed(factor, "v")))
+            else:
+                statements.append("    %s = %s %s" % (cell, cell, _signed(factor, "v")))
+        statements.append("    tape[p] = 0")
+        return statements
+    elif op == SCAN:
+        if argument == 1:
+            return ["p = tape.find(0, p)", "if p < 0: raise IndexError"]
+        elif argument == -1:
+            return ["p = tape.rfind(0, 0, p + 1)", "if p < 0: raise IndexError"]
+        return ["while tape[p]:", "    p += %d" % argument, "    if p < 0: raise IndexError"]
+    else:
+        return ["v = read()", "if v is not None: tape[p] = v"] * argument
+
+def _signed(amount, variable = None):
+    """Format adding amount, or amount times variable, as + x or - x"""
+    sign = "-" if amount < 0 else "+"
+    if variable is None:
+        return "%s %d" % (sign, abs(amount))
+    elif abs(amount) == 1:
+        return "%s %s" % (sign, variable)
+    return "%s %s * %d" % (sign, variable, abs(amount))
 
 class BrainfuckInterpreter(AbstractInterpreter):
-	def nextInstruction(self):
-		print("N")
+    """
+    Brainfuck Interpreter
+    """
+
+    def __init__(self, code, stdin, tape_size = 30000, overflow = "wrap", eof = 0,
+                 backend = "interpreter", **options):
+        """
+        Initialize a new interpreter.
+
+        Arguments:
+            code -- the code to execute as a string
+            stdin -- file-like object to read input from
+            tape_size -- number of cells on the tape
+            overflow -- "wrap" to wrap cell values around, "error" to stop
+                        the program when a cell leaves the range 0-255
+            eof -- value read at the end of input, -1 to leave the cell unchanged
+            backend -- "interpreter" to step through the program, "compiled"
+                       to translate it into a Python function first
+            options -- passed on to AbstractInterpreter
+        """
+        if overflow not in ("wrap", "error"):
+            raise ValueError("overflow has to be wrap or error, not " + str(overflow))
+        if tape_size < 1:
+            raise ValueError("tape_size has to be positive")
+        if not(-1 <= eof <= 255):
+            raise ValueError("eof has to be -1 or a cell value")
+        if backend not in ("interpreter", "compiled"):
+            raise ValueError("backend has to be interpreter or compiled, not " + str(backend))
+
+        super().__init__(load_program(code, overflow == "wrap"), stdin, **options)
+
+        self._function = None
+        if backend == "compiled":
+            self._function = compile_function(code, self.code, overflow == "wrap")
+
+        self.tape = bytearray(tape_size)
+        self.pointer = 0
+        # ANDing with -1 leaves a value as it is, which makes the bytearray
+        # raise on out of range values instead of wrapping them
+        self._mask = 255 if overflow == "wrap" else -1
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self._eof = None if eof == -1 else eof
+
+    def has_execution_finished(self):
+        return self.instruction_pointer >= len(self.code)
+
+    def instruction_name(self, index):
+        """The name of the operation at index, such as "output" """
+        return operation_names[self.code[index][0]]
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        # Trailing empty cells are left out and restored from the tape size
+        snapshot.update({"tape": bytes(self.tape).rstrip(b"\0").hex(),
+                         "pointer": self.pointer,
+                         "pending_output": self._decoder.getstate()[0].hex()})
+        return snapshot
+
+    def restore(self, snapshot):
+        super().restore(snapshot)
+        tape = bytes.fromhex(snapshot["tape"])
+        if len(tape) > len(self.tape):
+            raise ValueError("the snapshot's tape is longer than tape_size")
+        self.tape = bytearray(tape) + bytearray(len(self.tape) - len(tape))
+        self.pointer = snapshot["pointer"]
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self._decoder.setstate((bytes.fromhex(snapshot["pending_output"]), 0))
+
+    def next_instruction(self):
+        """Execute the next instruction as specified by InstructionPointer"""
+        self.execute(1)
+
+    def execute(self, max_steps = None):
+        """
+        Execute instructions until the program has finished
+
+        The compiled backend can only run a whole program at once, stepping
+        through it always uses the interpreter.
+
+        Arguments:
+            max_steps -- stop after this many instructions, None for no limit
+
+        Returns the number of instructions executed.
+        """
+        if self._function and max_steps is None and self.instruction_pointer == 0:
+            return self._execute_compiled()
+
+        program = self.code
+        end = len(program)
+        tape = self.tape
+        mask = self._mask
+        pointer = self.pointer
+        ip = self.instruction_pointer
+        executed = 0
+        try:
+            while ip < end and executed != max_steps:
+                op, argument = program[ip]
+                ip += 1
+                executed += 1
+                if op == ADD:
+                    tape[pointer] = (tape[pointer] + argument) & mask
+                elif op == MOVE:
+                    pointer += argument
+                    if pointer < 0:
+                        raise IndexError
+                elif op == CLOSE:
+                    if tape[pointer]:
+                        ip = argument
+                elif op == OPEN:
+                    if not(tape[pointer]):
+                        ip = argument
+                elif op == CLEAR:
+                    tape[pointer] = 0
+                elif op == MULTIPLY:
+                    value = tape[pointer]
+                    if value:
+                        factors, lowest = argument
+                        if pointer + lowest < 0:
+                            raise IndexError
+                        for offset, factor in factors:
+                            tape[pointer + offset] = (tape[pointer + offset] + value * factor) & mask
+                        tape[pointer] = 0
+                elif op == SCAN:
+                    if argument == 1:
+                        pointer = tape.find(0, pointer)
+                    elif argument == -1:
+                        pointer = tape.rfind(0, 0, pointer + 1)
+                    else:
+                        while tape[pointer]:
+                            pointer += argument
+                            if pointer < 0:
+                                raise IndexError
+                    if pointer < 0:
+                        raise IndexError
+                elif op == OUTPUT:
+                    self._write_cell(tape[pointer], argument)
+                else:
+                    for _ in range(argument):
+                        value = self._read_cell()
+                        if value is not None:
+                            tape[pointer] = value
+            if ip >= end:
+                self._finish_output()
+        except BudgetExceeded as error:
+            # Raised by output, which only knows the steps counted before
+            # this call
+            error.steps = self.steps + executed
+            raise
+        except IndexError:
+            raise RuntimeError("Tape pointer moved off the tape.") from None
+        except ValueError:
+            raise RuntimeError("Cell value out of range 0-255.") from None
+        finally:
+            self.pointer = pointer
+            self.instruction_pointer = ip
+        return executed
+
+    def _execute_compiled(self):
+        """Run the whole program through its compiled function"""
+        try:
+            self.pointer, executed = self._function(self.tape, self.pointer, self._read_cell,
+                                                    self._write_compiled)
+        except IndexError:
+            raise RuntimeError("Tape pointer moved off the tape.") from None
+        except ValueError:
+            raise RuntimeError("Cell value out of range 0-255.") from None
+        self.instruction_pointer = len(self.code)
+        try:
+            self._finish_output()
+        except BudgetExceeded as error:
+            error.steps = self.steps + executed
+            raise
+        return executed
+
+    def _write_compiled(self, value, count, executed):
+        """_write_cell for compiled functions, which pass the steps executed so far"""
+        try:
+            self._write_cell(value, count)
+        except BudgetExceeded as error:
+            error.steps = self.steps + executed
+            raise
+
+    def _write_cell(self, value, count):
+        """Output a cell value count times as UTF-8 encoded bytes"""
+        text = self._decoder.decode(bytes((value,)) * count)
+        if text:
+            self.output(text, False)
+
+    def _finish_output(self):
+        """Replace incomplete UTF-8 sequences left at the end of the output"""
+        text = self._decoder.decode(b"", True)
+        if text:
+            self.output(text, False)
+
+    def _read_cell(self):
+        """Read the value to store for ",", None to leave the cell unchanged"""
+        value = self.input_byte()
+        if value is None:
+            return self._eof
+        return value
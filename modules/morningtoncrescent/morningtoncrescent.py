@@ -6,16 +6,183 @@ More information: http://esolangs.org/wiki/Mornington_Crescent
 
 """
 
+import hashlib
+import json
+import marshal
+import os
 import re
-from esoterpret.interpreter.baseclass import AbstractInterpreter
-from modules.morningtoncrescent.stations import stations, lines
+import sys
+import time
+from collections import namedtuple
+from esoterpret.cache import cached, source_version
+from esoterpret.interpreter.baseclass import AbstractInterpreter, BudgetExceeded
+from esoterpret.trace import Tracer, parse_range
+from modules.morningtoncrescent.profiler import Profiler
+from modules.morningtoncrescent.stations import line_ids, station_ids, station_names, serves
+
+_instruction_pattern = re.compile("^Take (.*) Line to ([^#]*?)[\t ]*(#.*)?$")
+_integer_pattern     = re.compile(r"-?\d+")
+
+# Version of this interpreter and its network, for the program cache
+_version = source_version(__file__, os.path.join(os.path.dirname(__file__), "stations.py"))
+
+# A single pre-parsed "Take <line> Line to <destination>" trip. station is the
+# destination's id and handler the function executing it (both None for an
+# unknown station), position is the 1-based line number in the source file
+# and text the original source line.
+Instruction = namedtuple("Instruction", ["line", "destination", "station", "handler", "position", "text"])
+
+def compile_program(code):
+    """
+    Parse Mornington Crescent source code into a list of instructions
+
+    Arguments:
+        code -- the code to compile as a string
+    """
+    program = []
+    for position, text in enumerate(code.splitlines(), 1):
+        match = _instruction_pattern.match(text)
+
+        # Add only valid lines to the program, ignoring the rest.
+        if match:
+            destination = match.group(2)
+            station = station_ids.get(destination)
+            handler = None if station is None else _station_handlers[station]
+            program.append(Instruction(match.group(1), destination, station, handler, position, text))
+    return program
+
+def load_program(code):
+    """
+    Compile and check Mornington Crescent source code, loading both from
+    the program cache if the same code was compiled before
+
+    Returns the list of instructions and the list of problems found by
+    check_program.
+    """
+    def build():
+        program = compile_program(code)
+        return ([(instruction.line, instruction.destination, instruction.station,
+                  instruction.position, instruction.text) for instruction in program],
+                check_program(program))
+    instructions, problems = cached("program", "morningtoncrescent", _version, code, build)
+    program = [Instruction(line, destination, station,
+                           None if station is None else _station_handlers[station], position, text)
+               for line, destination, station, position, text in instructions]
+    return program, problems
+
+def check_program(program):
+    """
+    Validate every trip of a compiled program without executing it
+
+    The route is fixed by the program text, as an Angel jump resumes right
+    after the Temple the train is already standing at. Everything up to the
+    first trip to Mornington Crescent, which always ends the program, can
+    therefore be checked ahead of time.
+
+    Arguments:
+        program -- list of instructions as returned by compile_program
+
+    Returns a list of problems, which is empty for a valid program.
+    """
+    problems = []
+    location = "Mornington Crescent"
+    for instruction in program:
+        problem = trip_problem(location, instruction.destination, instruction.line)
+        if problem:
+            problems.append("line %d: %s" % (instruction.position, problem))
+        if instruction.destination == "Mornington Crescent":
+            return problems
+        location = instruction.destination
+    problems.append("You have to end at Mornington Crescent.")
+    return problems
+
+def optimize_program(program):
+    """
+    Remove and fuse instructions of a checked program without changing
+    what it does
+
+    Removed are two trips in a row to the same plain station, whose swaps
+    cancel out, and repeated trips to Hammersmith or Seven Sisters, which
+    can't change the accumulator again. A trip to Bank followed by one to
+    Hammersmith is fused into a single instruction. Temples and Angels are
+    never removed and nothing is merged across them, so every Angel still
+    jumps to the instruction following its Temple.
+
+    The steps saved are added to the interpreter's steps_saved by the
+    instruction following them.
+
+    Arguments:
+        program -- list of instructions that passed check_program
+
+    Returns the optimized list of instructions.
+    """
+    # The optimized instructions with the steps they save
+    optimized = []
+    saved = 0
+    for index, instruction in enumerate(program):
+        station = instruction.station
+        previous = optimized[-1][0] if optimized else None
+        if previous is not None and previous.station == station and (
+                instruction.handler is _swap or
+                station == _hammersmith_id or station == _seven_sisters_id):
+            if instruction.handler is _swap:
+                saved += optimized.pop()[1] + 2
+            else:
+                saved += 1
+        elif previous is not None and previous.handler is _bank and station == _hammersmith_id:
+            fused = instruction._replace(handler=_bank_hammersmith, position=previous.position,
+                                         text=previous.text + "\n" + instruction.text)
+            optimized[-1] = (fused, optimized[-1][1] + saved + 1)
+            saved = 0
+        else:
+            optimized.append((instruction, saved))
+            saved = 0
+        if station == _mornington_crescent_id:
+            # The program always ends here
+            return [_saving(instruction, saved) for instruction, saved in optimized] + program[index + 1:]
+    return [_saving(instruction, saved) for instruction, saved in optimized]
+
+def _saving(instruction, saved):
+    """Make an instruction add the steps saved in front of it to steps_saved"""
+    if not(saved):
+        return instruction
+    handler = instruction.handler
+    def saving_handler(interpreter, station):
+        interpreter.steps_saved += saved
+        handler(interpreter, station)
+    # Read by generate_source
+    saving_handler.handler = handler
+    saving_handler.saved = saved
+    return instruction._replace(handler=saving_handler)
+
+def trip_problem(origin, destination, line):
+    """
+    Describe why travel between two stations using a given line is not
+    allowed, or return None if it is
+
+    Arguments:
+        origin -- the station the train leaves from
+        destination -- the destination station
+        line -- the line to use
+    """
+    if line not in line_ids:
+        return "Line " + line + " doesn't exist."
+    elif destination not in station_ids:
+        return "Station " + destination + " doesn't exist."
+    elif origin in station_ids and not serves(station_ids[origin], line_ids[line]):
+        return "Station " + origin + " doesn't have access to " + line + " Line."
+    elif not serves(station_ids[destination], line_ids[line]):
+        return "Station " + destination + " doesn't have access to " + line + " Line."
 
 class MorningtonCrescentInterpreter(AbstractInterpreter):
     """
     Mornington Crescent Interpreter
     """
 
-    def __init__(self, code, stdin, verbose = False):
+    def __init__(self, code, stdin, verbose = False, optimize = False, backend = "interpreter",
+                 profile = None, trace = None,
+                 trace_every = 1, trace_range = None, trace_last = 0,
+                 max_int_bits = 2 ** 23, max_string_length = 2 ** 22, **options):
         """
         Initialize a new interpreter.
 
@@ -23,55 +190,259 @@ class MorningtonCrescentInterpreter(AbstractInterpreter):
             code -- the code to execute as a string
             stdin -- file-like object to read initial accumulator from
             verbose -- whether to print out each step as it is executed
+            optimize -- whether to remove redundant trips with optimize_program.
+                        Instruction indices then refer to the optimized program.
+            backend -- "interpreter" to step through the program, "compiled"
+                       to translate it into a Python function first
+            profile -- "text" or "json" to profile the program and write a
+                       report to stderr when it ends, None to not profile.
+                       Has no effect together with verbose.
+            trace -- file to write an execution trace to, as JSON lines if
+                     it ends in .jsonl and binary otherwise, None to not trace
+            trace_every -- only trace every nth step
+            trace_range -- only trace instruction pointers in a range such
+                           as "10:20", None for all
+            trace_last -- only write the last this many traced steps, when
+                          the program fails, 0 to write all of them
+            max_int_bits -- largest bit length an integer may grow to, None for no limit
+            max_string_length -- largest length a string may grow to, None for no limit
+            options -- passed on to AbstractInterpreter
         """
-        newcode = []
-        for line in iter(code.splitlines()):
-            pattern = re.compile("^Take (.*) Line to ([^#]*?)[\t ]*(#.*)?$")
-
-            # Add only valid Lines to the code list, ignoring the rest.
-            if pattern.match(line):
-                newcode.append(line)
-        super().__init__(newcode, stdin)
+        program, problems = load_program(code)
+        if problems:
+            raise RuntimeError(problems[0])
+        if profile not in (None, "text", "json"):
+            raise ValueError("profile has to be text or json, not " + str(profile))
+        if backend not in ("interpreter", "compiled"):
+            raise ValueError("backend has to be interpreter or compiled, not " + str(backend))
+        if optimize:
+            program = optimize_program(program)
+        super().__init__(program, stdin, **options)
+
+        self._function = None
+        if backend == "compiled":
+            self._function = compile_function(code, program, optimize)
+
+        self.tracer = None
+        if trace is not None:
+            if isinstance(trace_range, str):
+                trace_range = parse_range(trace_range)
+            self.tracer = Tracer(trace, trace_every, trace_range, trace_last)
 
         self._verbose = verbose
+        self._profile_format = profile
+        self.profiler = None if profile is None else Profiler(program)
+        self._instrumentation_finished = False
+        # Steps the optimizer saved so far
+        self.steps_saved = 0
+        self.max_int_bits = max_int_bits
+        self.max_string_length = max_string_length
         self.accumulator = self.input()
 
-        self.station_values = {}
-        # Initialize Station Values to their names
-        for station in stations:
-            self.station_values[station] = station
+        # Station values indexed by station id, initially their names
+        self.station_values = list(_initial_values)
         self.location = "Mornington Crescent"
         self.jumpstack = []
 
+    @classmethod
+    def check(cls, code):
+        return load_program(code)[1]
+
+    def instruction_name(self, index):
+        """The destination station of the instruction at index"""
+        return self.code[index].destination
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot.update({"accumulator": self.accumulator,
+                         "station_values": list(self.station_values),
+                         "jumpstack": list(self.jumpstack),
+                         "location": self.location,
+                         "steps_saved": self.steps_saved})
+        return snapshot
+
+    def restore(self, snapshot):
+        super().restore(snapshot)
+        self.accumulator = snapshot["accumulator"]
+        self.station_values = list(snapshot["station_values"])
+        self.jumpstack = list(snapshot["jumpstack"])
+        self.location = snapshot["location"]
+        self.steps_saved = snapshot["steps_saved"]
+
+    def clone(self, stdin = None, sink = None):
+        """
+        Create an interpreter in the same state, sharing the compiled code
+
+        A clone of an interpreter that hasn't started yet with a new stdin
+        reads its initial accumulator from there.
+
+        Arguments:
+            stdin -- file-like object the clone reads from, the same as this one's by default
+            sink -- OutputSink to write output to, buffered stdout by default
+        """
+        clone = super().clone(stdin, sink)
+        if stdin is not None and self.instruction_pointer == 0:
+            clone.accumulator = clone.input()
+        return clone
+
     def has_execution_finished(self):
         if self.location == "Mornington Crescent" and self.instruction_pointer > 0:
             return True
         elif self.instruction_pointer >= len(self.code):
             raise RuntimeError("You have to end at Mornington Crescent.")
 
-    def next_instruction(self):
-        """Execute the next instruction as specified by InstructionPointer"""
+    def execute(self, max_steps = None):
+        """
+        Execute instructions until the program has finished
+
+        The compiled backend can only run a whole program at once without
+        verbose output, profiling or tracing, the interpreter is used
+        otherwise.
+
+        Arguments:
+            max_steps -- stop after this many instructions, None for no limit
+
+        Returns the number of instructions executed.
+        """
+        if self._verbose:
+            return super().execute(max_steps)
+        if self.profiler is not None or self.tracer is not None:
+            return self._execute_instrumented(max_steps)
+        if self._function and max_steps is None and self.instruction_pointer == 0:
+            return self._execute_compiled()
+
+        code = self.code
+        executed = 0
+        finished = self.location == "Mornington Crescent" and self.instruction_pointer > 0
+        try:
+            while not(finished) and executed != max_steps:
+                instruction = code[self.instruction_pointer]
+                self.location = instruction.destination
+                instruction.handler(self, instruction.station)
+                self.instruction_pointer += 1
+                executed += 1
+                # The route has been checked, so the program always ends here
+                finished = instruction.station == _mornington_crescent_id
+        except BudgetExceeded as error:
+            # The caps of _check_bits and _check_length only know the steps
+            # counted before this call
+            error.steps = self.steps + executed
+            raise
+        return executed
+
+    def _execute_compiled(self):
+        """Run the whole program through its compiled function"""
+        try:
+            executed, saved = self._function(self, self.station_values)
+        except BudgetExceeded as error:
+            error.steps = self.steps + self._compiled_steps
+            self.steps_saved += self._compiled_saved
+            raise
+        self.steps_saved += saved
+        self.instruction_pointer = self._function.end
+        self.location = "Mornington Crescent"
+        self.jumpstack = list(self._function.jumpstack)
+        return executed
+
+    def _execute_instrumented(self, max_steps):
+        """The loop of execute, feeding every step to the profiler and tracer"""
+        profiler = self.profiler
+        tracer = self.tracer
+        clock = time.perf_counter
+        code = self.code
+        executed = 0
+        finished = self.location == "Mornington Crescent" and self.instruction_pointer > 0
+        try:
+            while not(finished) and executed != max_steps:
+                ip = self.instruction_pointer
+                instruction = code[ip]
+                station = instruction.station
+                if tracer is not None and tracer.wants(self.steps + executed, ip):
+                    tracer.record(self.steps + executed, ip, instruction.position, instruction.destination,
+                                  self.accumulator, self.station_values[station])
+                self.location = instruction.destination
+                if profiler is None:
+                    instruction.handler(self, station)
+                else:
+                    start = clock()
+                    instruction.handler(self, station)
+                    profiler.station_time[station] += clock() - start
+                    profiler.station_visits[station] += 1
+                    profiler.instruction_visits[ip] += 1
+                    if station == _temple_id and len(self.jumpstack) > profiler.max_jumpstack_depth:
+                        profiler.max_jumpstack_depth = len(self.jumpstack)
+                self.instruction_pointer += 1
+                executed += 1
+                finished = station == _mornington_crescent_id
+        except Exception as error:
+            if isinstance(error, BudgetExceeded):
+                error.steps = self.steps + executed
+            self._finish_instrumentation(True)
+            raise
+        if finished:
+            self._finish_instrumentation(False)
+        return executed
+
+    def stopped(self, error):
+        """Finish the trace and profile however run ended, e.g. stopped by a limit"""
+        if error is not None:
+            self._finish_instrumentation(True)
+        elif self.has_execution_finished():
+            self._finish_instrumentation(False)
+        elif self.profiler is not None:
+            # Paused after max_steps, report the profile so far
+            self._write_profile()
+
+    def _finish_instrumentation(self, failed):
+        """
+        Close the trace, writing the steps kept in memory if the program
+        failed, and write the profile, once the program has ended
+        """
+        if self._instrumentation_finished:
+            return
+        self._instrumentation_finished = True
+        if self.tracer is not None:
+            if failed:
+                self.tracer.fail()
+            else:
+                self.tracer.close()
+        if self.profiler is not None:
+            self._write_profile()
+
+    def _write_profile(self):
+        if self._profile_format == "json":
+            report = self.profiler.report()
+            report["steps_saved"] = self.steps_saved
+            report = json.dumps(report)
+        else:
+            report = self.profiler.format()
+            if self.steps_saved:
+                report += "\n\n%d steps saved by the optimizer" % self.steps_saved
+        self.flush()
+        sys.stderr.write(report + "\n")
 
-        code    = self.code[self.instruction_pointer]
-        pattern = re.compile("^Take (.*) Line to ([^#]*?)[\t ]*(#.*)?$")
+    def next_instruction(self):
+        """
+        Execute the next instruction as specified by InstructionPointer
 
-        match       = pattern.match(code)
-        line        = match.group(1)
-        destination = match.group(2)
+        Trips are not validated here, the whole route has been checked by
+        check_program before execution started.
+        """
 
-        self.validate_trip(destination, line)
+        instruction = self.code[self.instruction_pointer]
 
         # Debug
         if self._verbose:
-            print ("[" + str(self.instruction_pointer) + "] " + code)
-            print ("Before: %s (%s)" % (repr(self.accumulator), repr(self.station_values[destination])))
+            self.output("[" + str(self.instruction_pointer) + "] " + instruction.text)
+            self.output("Before: %s (%s)" % (repr(self.accumulator), repr(self.station_values[instruction.station])))
 
-        self.execute_station(destination)
+        self.location = instruction.destination
+        instruction.handler(self, instruction.station)
 
         # Debug
         if self._verbose:
-            print ("After:  %s (%s)" % (repr(self.accumulator), repr(self.station_values[self.location])))
-            print ("")
+            self.output("After:  %s (%s)" % (repr(self.accumulator), repr(self.station_values[station_ids[self.location]])))
+            self.output("")
 
         self.instruction_pointer += 1
 
@@ -84,14 +455,9 @@ class MorningtonCrescentInterpreter(AbstractInterpreter):
             line - the line to use
         """
 
-        if line not in lines:
-            raise RuntimeError("Line " + line + " doesn't exist.")
-        elif destination not in stations:
-            raise RuntimeError("Station " + destination + " doesn't exist.")
-        elif line not in stations[self.location]:
-            raise RuntimeError("Station " + self.location + " doesn't have access to " + line + " Line.")
-        elif line not in stations[destination]:
-            raise RuntimeError("Station " + destination + " doesn't have access to " + line + " Line.")
+        problem = trip_problem(self.location, destination, line)
+        if problem:
+            raise RuntimeError(problem)
 
     def execute_station(self, station):
         """
@@ -101,195 +467,449 @@ class MorningtonCrescentInterpreter(AbstractInterpreter):
             station -- The destination station
         """
         self.location = station
+        _station_handlers[station_ids[station]](self, station_ids[station])
+
+# Shared template the station values of every interpreter are copied from
+_initial_values = tuple(station_names)
+
+_hammersmith_id         = station_ids["Hammersmith"]
+_temple_id              = station_ids["Temple"]
+_angel_id               = station_ids["Angel"]
+_marble_arch_id         = station_ids["Marble Arch"]
+_seven_sisters_id       = station_ids["Seven Sisters"]
+_bank_id                = station_ids["Bank"]
+_mornington_crescent_id = station_ids["Mornington Crescent"]
+
+# Station handlers. Each one is called with the interpreter and the id of
+# the destination station, after the interpreter has moved there.
+
+def _check_bits(interpreter, bits):
+    """Refuse to create an integer of the given bit length if it is too large"""
+    if interpreter.max_int_bits is not None and bits > interpreter.max_int_bits:
+        raise BudgetExceeded("int_bits", interpreter.max_int_bits, interpreter.steps)
+
+def _check_length(interpreter, length):
+    """Refuse to create a string of the given length if it is too long"""
+    if interpreter.max_string_length is not None and length > interpreter.max_string_length:
+        raise BudgetExceeded("string_length", interpreter.max_string_length, interpreter.steps)
+
+def _swap(interpreter, station):
+    """Default: exchange the accumulator with the station's value"""
+    values = interpreter.station_values
+    interpreter.accumulator, values[station] = values[station], interpreter.accumulator
+
+def _arithmetic(action, bits = None):
+    """
+    Build a handler for a station that combines two integers
 
-        action = None
-        performDefault = False
-
-        # add
-        if station == "Upminster":
-            action = lambda a, b : a + b
-
-        # multiplier
-        elif station == "Chalfont & Latimer":
-            action = lambda a, b : a * b
-        
-        # integer division
-        elif station == "Cannon Street":
-            action = lambda a, b : "" if a == 0 else b // a
-
-        # remainder
-        elif station == "Preston Road":
-            action = lambda a, b : "" if a == 0 else b % a
-        
-        # max
-        elif station == "Bounds Green":
-            action = lambda a, b : max(a, b)
-        
-        # bitwise NOR
-        elif station == "Manor House":
-            action = lambda a, b : ~(a | b)
-
-        # bitwise AND
-        elif station == "Holland Park":
-            action = lambda a, b : a & b
-
-        # bitwise Shift-Right
-        elif station == "Turnham Green":
-            action = lambda a, b : b if a == 0 else b >> a
-
-        # bitwise Shift-Left
-        elif station == "Stepney Green":
-            action = lambda a, b : b if a == 0 else b << a
-
-        # square
-        elif station == "Russell Square":
-            if isinstance(self.station_values[station], int):
-                self.accumulator, self.station_values[station] = self.station_values[station] ** 2, self.accumulator
-            else:
-                performDefault = True
-
-        # bitwise NOT
-        elif station == "Notting Hill Gate":
-            if isinstance(self.station_values[station], int):
-                self.accumulator, self.station_values[station] = ~self.station_values[station], self.accumulator
-            else:
-                performDefault = True
-
-        # parse string to integer
-        elif station == "Parsons Green":
-            if isinstance(self.accumulator, str):
-                match = re.search("-?\d+", self.accumulator)
-                new_value = 0 if not(match) else self.accumulator[match.end():]
-                self.accumulator = 0 if not(match) else int(match.group())
-                self.station_values[station] = "" if not(match) else new_value
-            else:
-                performDefault = True
-
-        # 7
-        elif station == "Seven Sisters":
-            self.accumulator = 7
-
-        # character <> codepoint
-        elif station == "Charing Cross":
-            acc = self.accumulator
-            if isinstance(self.station_values[station], str):
-                self.accumulator = ord(self.station_values[station][0]) if self.station_values[station] else 0
-            else:
-                self.accumulator = chr(self.station_values[station])
-
-            self.station_values[station] = acc
-
-        # string concatenation
-        elif station == "Paddington":
-            acc = self.accumulator
-            if isinstance(self.station_values[station], str) and isinstance(self.accumulator, str):
-                self.accumulator = self.station_values[station] + self.accumulator
-                self.station_values[station] = acc
-            else:
-                performDefault = True
-
-        # left substring
-        elif station == "Gunnersbury":
-            acc = self.accumulator
-            if type(self.station_values[station]) == type(self.accumulator):
-                performDefault = True
-            elif isinstance(self.station_values[station], str):
-                if self.accumulator < 0:
-                    raise RuntimeError("Cannot be negative.")
-                
-                self.accumulator = self.station_values[station][:self.accumulator]
-                self.station_values[station] = acc
-
-            else:
-                if self.station_values[station] < 0:
-                    raise RuntimeError("Cannot be negative.")
-
-                self.accumulator = self.accumulator[:self.station_values[station]]
-                self.station_values[station] = acc
-
-        # right substring
-        elif station == "Mile End":
-            acc = self.accumulator
-            if type(self.station_values[station]) == type(self.accumulator):
-                performDefault = True
-            elif isinstance(self.station_values[station], str):
-                if self.accumulator < 0:
-                    raise RuntimeError("Cannot be negative.")
-
-                self.accumulator = self.station_values[station][-self.accumulator:]
-                self.station_values[station] = acc
+    Arguments:
+        action -- function of (accumulator, station value) giving the new accumulator
+        bits -- function of the same arguments giving an upper bound of the
+                result's bit length, for stations whose result can outgrow
+                their operands
+    """
+    def handler(interpreter, station):
+        values = interpreter.station_values
+        acc = interpreter.accumulator
+        if isinstance(acc, int) and isinstance(values[station], int):
+            if bits is not None:
+                _check_bits(interpreter, bits(acc, values[station]))
+            interpreter.accumulator = action(acc, values[station])
+            values[station] = acc
+        else:
+            interpreter.accumulator, values[station] = values[station], acc
+    return handler
 
-            else:
-                if self.station_values[station] < 0:
-                    raise RuntimeError("Cannot be negative.")
-
-                self.accumulator = self.accumulator[-self.station_values[station]:]
-                self.station_values[station] = acc
-
-        # upper-case
-        elif station == "Upney":
-            acc = self.accumulator
-            if isinstance(self.station_values[station], str):
-                self.accumulator = self.station_values[station].upper()
-                self.station_values[station] = acc
-            else:
-                performDefault = True
-
-        # lower-case
-        elif station == "Hounslow Central":
-            acc = self.accumulator
-            if isinstance(self.station_values[station], str):
-                self.accumulator = self.station_values[station].lower()
-                self.station_values[station] = acc
-            else:
-                performDefault = True
-
-        # reverse string
-        elif station == "Turnpike Lane":
-            acc = self.accumulator
-            if isinstance(self.station_values[station], str):
-                self.accumulator = self.station_values[station][::-1]
-                self.station_values[station] = acc
-            else:
-                performDefault = True
+def _unary_int(action, bits = None):
+    """
+    Build a handler that applies action to an integer station value
 
-        # store
-        elif station == "Bank":
-            # Set Hammersmith to the same value
-            self.station_values["Hammersmith"] = self.accumulator
-            performDefault = True
+    Arguments:
+        action -- function of the station value giving the new accumulator
+        bits -- function of the station value giving an upper bound of the
+                result's bit length, for actions that can grow the value
+    """
+    def handler(interpreter, station):
+        values = interpreter.station_values
+        if isinstance(values[station], int):
+            if bits is not None:
+                _check_bits(interpreter, bits(values[station]))
+            interpreter.accumulator, values[station] = action(values[station]), interpreter.accumulator
+        else:
+            interpreter.accumulator, values[station] = values[station], interpreter.accumulator
+    return handler
+
+def _unary_str(action):
+    """Build a handler that applies action to a string station value"""
+    def handler(interpreter, station):
+        values = interpreter.station_values
+        if isinstance(values[station], str):
+            interpreter.accumulator, values[station] = action(values[station]), interpreter.accumulator
+        else:
+            interpreter.accumulator, values[station] = values[station], interpreter.accumulator
+    return handler
 
-        # retain
-        elif station == "Hammersmith":
-            self.accumulator = self.station_values[station]
+def _substring(action):
+    """
+    Build a handler for a station that cuts a string to an integer length
 
-        # continuation
-        elif station == "Temple":
-            self.jumpstack.append(self.instruction_pointer)
+    Arguments:
+        action -- function of (string, length) giving the substring
+    """
+    def handler(interpreter, station):
+        values = interpreter.station_values
+        acc = interpreter.accumulator
+        if type(values[station]) == type(acc):
+            interpreter.accumulator, values[station] = values[station], acc
+        elif isinstance(values[station], str):
+            if acc < 0:
+                raise RuntimeError("Cannot be negative.")
+
+            interpreter.accumulator = action(values[station], acc)
+            values[station] = acc
+        else:
+            if values[station] < 0:
+                raise RuntimeError("Cannot be negative.")
+
+            interpreter.accumulator = action(acc, values[station])
+            values[station] = acc
+    return handler
+
+def _parsons_green(interpreter, station):
+    """Parse the leading integer out of a string accumulator"""
+    if isinstance(interpreter.accumulator, str):
+        match = _integer_pattern.search(interpreter.accumulator)
+        if match:
+            # Every decimal digit adds less than 10/3 bits
+            _check_bits(interpreter, (match.end() - match.start()) * 10 // 3)
+        new_value = 0 if not(match) else interpreter.accumulator[match.end():]
+        interpreter.accumulator = 0 if not(match) else int(match.group())
+        interpreter.station_values[station] = "" if not(match) else new_value
+    else:
+        _swap(interpreter, station)
+
+def _seven_sisters(interpreter, station):
+    interpreter.accumulator = 7
+
+def _charing_cross(interpreter, station):
+    """Convert between a character and its codepoint"""
+    values = interpreter.station_values
+    acc = interpreter.accumulator
+    if isinstance(values[station], str):
+        interpreter.accumulator = ord(values[station][0]) if values[station] else 0
+    else:
+        interpreter.accumulator = chr(values[station])
+
+    values[station] = acc
+
+def _paddington(interpreter, station):
+    """Concatenate two strings"""
+    values = interpreter.station_values
+    acc = interpreter.accumulator
+    if isinstance(values[station], str) and isinstance(acc, str):
+        _check_length(interpreter, len(values[station]) + len(acc))
+        interpreter.accumulator = values[station] + acc
+        values[station] = acc
+    else:
+        _swap(interpreter, station)
+
+def _bank(interpreter, station):
+    # Set Hammersmith to the same value
+    interpreter.station_values[_hammersmith_id] = interpreter.accumulator
+    _swap(interpreter, station)
+
+def _bank_hammersmith(interpreter, station):
+    """A trip to Bank followed by one to Hammersmith, fused by optimize_program"""
+    values = interpreter.station_values
+    values[_bank_id] = values[_hammersmith_id] = interpreter.accumulator
+
+def _hammersmith(interpreter, station):
+    interpreter.accumulator = interpreter.station_values[station]
+
+def _temple(interpreter, station):
+    interpreter.jumpstack.append(interpreter.instruction_pointer)
+
+def _angel(interpreter, station):
+    if interpreter.accumulator != 0:
+        interpreter.location = "Temple"
+        interpreter.instruction_pointer = interpreter.jumpstack[-1]
+
+def _marble_arch(interpreter, station):
+    del interpreter.jumpstack[-1]
+
+def _mornington_crescent(interpreter, station):
+    interpreter.output(interpreter.accumulator)
+
+_special_stations = {
+    # add
+    "Upminster": _arithmetic(lambda a, b : a + b,
+                             lambda a, b : max(a.bit_length(), b.bit_length()) + 1),
+    # multiplier
+    "Chalfont & Latimer": _arithmetic(lambda a, b : a * b,
+                                      lambda a, b : a.bit_length() + b.bit_length()),
+    # integer division
+    "Cannon Street": _arithmetic(lambda a, b : "" if a == 0 else b // a),
+    # remainder
+    "Preston Road": _arithmetic(lambda a, b : "" if a == 0 else b % a),
+    # max
+    "Bounds Green": _arithmetic(lambda a, b : max(a, b)),
+    # bitwise NOR
+    "Manor House": _arithmetic(lambda a, b : ~(a | b)),
+    # bitwise AND
+    "Holland Park": _arithmetic(lambda a, b : a & b),
+    # bitwise Shift-Right
+    "Turnham Green": _arithmetic(lambda a, b : b if a == 0 else b >> a),
+    # bitwise Shift-Left
+    "Stepney Green": _arithmetic(lambda a, b : b if a == 0 else b << a,
+                                 lambda a, b : b.bit_length() + max(a, 0)),
+    # square
+    "Russell Square": _unary_int(lambda a : a ** 2, lambda a : 2 * a.bit_length()),
+    # bitwise NOT
+    "Notting Hill Gate": _unary_int(lambda a : ~a),
+    # parse string to integer
+    "Parsons Green": _parsons_green,
+    # 7
+    "Seven Sisters": _seven_sisters,
+    # character <> codepoint
+    "Charing Cross": _charing_cross,
+    # string concatenation
+    "Paddington": _paddington,
+    # left substring
+    "Gunnersbury": _substring(lambda string, length : string[:length]),
+    # right substring
+    "Mile End": _substring(lambda string, length : string[-length:]),
+    # upper-case
+    "Upney": _unary_str(lambda a : a.upper()),
+    # lower-case
+    "Hounslow Central": _unary_str(lambda a : a.lower()),
+    # reverse string
+    "Turnpike Lane": _unary_str(lambda a : a[::-1]),
+    # store
+    "Bank": _bank,
+    # retain
+    "Hammersmith": _hammersmith,
+    # continuation
+    "Temple": _temple,
+    # if
+    "Angel": _angel,
+    # pop
+    "Marble Arch": _marble_arch,
+    # output/exit
+    "Mornington Crescent": _mornington_crescent,
+}
+
+# Handler for every station, indexed by station id
+_station_handlers = [_special_stations.get(name, _swap) for name in station_names]
+
+# Python source of the integer stations, which generate_source inlines.
+# Each has to compute the same as its handler in _special_stations, a is
+# the accumulator and b the station's value. The second expression is an
+# upper bound of the result's bit length for stations that can grow it.
+_arithmetic_sources = {
+    "Upminster": ("{a} + {b}", "max({a}.bit_length(), {b}.bit_length()) + 1"),
+    "Chalfont & Latimer": ("{a} * {b}", "{a}.bit_length() + {b}.bit_length()"),
+    "Cannon Street": ("\"\" if {a} == 0 else {b} // {a}", None),
+    "Preston Road": ("\"\" if {a} == 0 else {b} % {a}", None),
+    "Bounds Green": ("max({a}, {b})", None),
+    "Manor House": ("~({a} | {b})", None),
+    "Holland Park": ("{a} & {b}", None),
+    "Turnham Green": ("{b} if {a} == 0 else {b} >> {a}", None),
+    "Stepney Green": ("{b} if {a} == 0 else {b} << {a}", "{b}.bit_length() + max({a}, 0)"),
+}
+_unary_int_sources = {
+    "Russell Square": ("{b} ** 2", "2 * {b}.bit_length()"),
+    "Notting Hill Gate": ("~{b}", None),
+}
+
+# Python functions generated from Mornington Crescent programs, keyed by a
+# hash of the source and whether it was optimized
+_compiled_functions = {}
+
+def compile_function(code, program, optimized = False):
+    """
+    Translate a checked program into a Python function, or return None if
+    its jumps can't be turned into loops or Python cannot compile it
+    (loops nested too deeply)
+
+    The function takes the interpreter and its station values, runs the
+    whole program and returns the number of instructions executed and the
+    steps saved by the optimizer. Its end attribute is the instruction
+    pointer after the final trip and its jumpstack attribute the jump stack
+    left at the end.
+
+    Arguments:
+        code -- the Mornington Crescent source the program was compiled from
+        program -- list of instructions as returned by compile_program
+        optimized -- whether the program went through optimize_program
+    """
+    key = hashlib.sha1(("%s:%s" % (optimized, code)).encode("utf-8")).hexdigest()
+    if key not in _compiled_functions:
+        # The code object is cached on disk, marshalled
+        compiled, end, jumpstack = cached("function", "morningtoncrescent", _version,
+                                          "%s:%s" % (optimized, code),
+                                          lambda: _compile_source(program))
+        function = None
+        if compiled is not None:
+            namespace = {"handlers": _station_handlers, "check_bits": _check_bits}
+            exec(marshal.loads(compiled), namespace)
+            function = namespace["run"]
+            function.end, function.jumpstack = end, jumpstack
+        _compiled_functions[key] = function
+    return _compiled_functions[key]
+
+def _compile_source(program):
+    """
+    Compile the function of a program, returning its marshalled code
+    object, its end and its jump stack, or Nones if it can't be compiled
+    """
+    structure = _jump_structure(program)
+    if structure is None:
+        return None, None, None
+    try:
+        compiled = compile(generate_source(program, structure), "<morningtoncrescent>", "exec")
+    except SyntaxError:
+        return None, None, None
+    return marshal.dumps(compiled), structure[1] + 1, structure[2]
+
+def _jump_structure(program):
+    """
+    Find the Angels jumping back to every Temple, up to the final trip
 
-        # if
-        elif station == "Angel":
-            if self.accumulator != 0:
-                self.location = "Temple"
-                self.instruction_pointer = self.jumpstack[-1]
+    Every Angel jumps to the Temple on top of the jump stack, which only
+    depends on the instructions in front of it. A Temple with Angels
+    becomes a loop ending at its last Angel.
 
-        # pop
-        elif station == "Marble Arch":
-            del self.jumpstack[-1]
+    Returns a tuple of a dict of Temple indices to the index of their last
+    Angel, the index of the final trip and the jump stack left there, or
+    None if an Angel or Marble Arch may find the jump stack empty.
+    """
+    stack = []
+    last_angels = {}
+    for index, instruction in enumerate(program):
+        station = instruction.station
+        if station == _temple_id:
+            stack.append(index)
+        elif station == _marble_arch_id:
+            if not(stack):
+                return None
+            stack.pop()
+        elif station == _angel_id:
+            if not(stack):
+                return None
+            last_angels[stack[-1]] = index
+        elif station == _mornington_crescent_id:
+            return last_angels, index, stack
+    return None
+
+def generate_source(program, structure):
+    """
+    Generate the Python source of a function running a checked program
 
-        # output/exit
-        elif station == "Mornington Crescent":
-            self.output(self.accumulator)
+    The accumulator and the values of the stations used are held in
+    local variables. Temples with Angels become while loops, whose Angels
+    continue the loop unless the accumulator is 0. Stations that aren't
+    inlined call their handler with the locals written back.
 
+    Arguments:
+        program -- list of instructions as returned by compile_program
+        structure -- its jumps as returned by _jump_structure
+    """
+    last_angels, end, _ = structure
+    used = {_hammersmith_id, _bank_id}
+    used.update(instruction.station for instruction in program[:end + 1])
+
+    lines = ["def run(interp, values):",
+             "    acc = interp.accumulator",
+             "    output = interp.output",
+             "    max_bits = interp.max_int_bits",
+             "    steps = saved = 0"]
+    lines.extend("    v%d = values[%d]" % (station, station) for station in sorted(used))
+    lines.append("    try:")
+
+    # Steps and saved steps not yet added to the counters
+    pending = [0, 0]
+    def flush(indent):
+        if pending[0]:
+            lines.append(indent + "steps += %d" % pending[0])
+        if pending[1]:
+            lines.append(indent + "saved += %d" % pending[1])
+        pending[0] = pending[1] = 0
+
+    loops = []
+    for index, instruction in enumerate(program[:end + 1]):
+        indent = "    " * (len(loops) + 2)
+        handler = instruction.handler
+        pending[0] += 1
+        if hasattr(handler, "saved"):
+            pending[1] += handler.saved
+            handler = handler.handler
+
+        station = instruction.station
+        if station == _temple_id:
+            if index in last_angels:
+                flush(indent)
+                lines.append(indent + "while True:")
+                loops.append(index)
+        elif station == _angel_id:
+            flush(indent)
+            lines.append(indent + "if acc != 0: continue")
+            if last_angels[loops[-1]] == index:
+                lines.append(indent + "break")
+                loops.pop()
+        elif station == _mornington_crescent_id:
+            # The output can hit the output limit, see below
+            pending[0] -= 1
+            flush(indent)
+            pending[0] += 1
+            lines.append(indent + "output(acc)")
+            flush(indent)
+            lines.append(indent + "return steps, saved")
+        elif station != _marble_arch_id:
+            source = _station_source(handler, station)
+            if any("check_bits(" in line or "handlers[" in line for line in source):
+                # Stations that can hit a cap get the steps before them
+                # counted, so that the error reports them exactly
+                pending[0] -= 1
+                flush(indent)
+                pending[0] += 1
+            lines.extend(indent + line for line in source)
+
+    lines.append("    finally:")
+    lines.append("        interp.accumulator = acc")
+    lines.append("        interp._compiled_steps = steps")
+    lines.append("        interp._compiled_saved = saved")
+    lines.extend("        values[%d] = v%d" % (station, station) for station in sorted(used))
+    return "\n".join(lines) + "\n"
+
+def _station_source(handler, station):
+    """Python statements for a trip to a station other than the jumps"""
+    name = station_names[station]
+    value = "v%d" % station
+    if handler is _swap:
+        return ["acc, %s = %s, acc" % (value, value)]
+    elif handler is _seven_sisters:
+        return ["acc = 7"]
+    elif handler is _hammersmith:
+        return ["acc = v%d" % _hammersmith_id]
+    elif handler is _bank:
+        return ["v%d = acc" % _hammersmith_id, "acc, %s = %s, acc" % (value, value)]
+    elif handler is _bank_hammersmith:
+        return ["v%d = v%d = acc" % (_bank_id, _hammersmith_id)]
+    elif name in _arithmetic_sources or name in _unary_int_sources:
+        if name in _arithmetic_sources:
+            expression, bits = _arithmetic_sources[name]
+            statements = ["if type(acc) is int and type(%s) is int:" % value]
         else:
-            performDefault = True
-
-        if action is not None:
-            if isinstance(self.accumulator, int) and isinstance(self.station_values[station], int):
-                acc = self.accumulator
-                self.accumulator = action(acc, self.station_values[station])
-                self.station_values[station] = acc
-            else:
-                performDefault = True
-        if performDefault:
-            self.accumulator, self.station_values[station] = self.station_values[station], self.accumulator
+            expression, bits = _unary_int_sources[name]
+            statements = ["if type(%s) is int:" % value]
+        if bits is not None:
+            statements.append("    if max_bits is not None: check_bits(interp, %s)" % bits.format(a="acc", b=value))
+        statements += ["    acc, %s = %s, acc" % (value, expression.format(a="acc", b=value)),
+                       "else:",
+                       "    acc, %s = %s, acc" % (value, value)]
+        return statements
+    return ["interp.accumulator = acc",
+            "values[%d] = %s" % (station, value),
+            "handlers[%d](interp, %d)" % (station, station),
+            "acc = interp.accumulator",
+            "%s = values[%d]" % (value, station)]
@@ -0,0 +1,73 @@
+"""
+Execution profile of a Mornington Crescent program
+
+The interpreter fills the counters directly from its profiling loop, this
+module only turns them into a report.
+"""
+from modules.morningtoncrescent.stations import station_names
+
+class Profiler:
+    """
+    Visits and handler time per station and source line of one program
+    """
+
+    def __init__(self, program):
+        """
+        Arguments:
+            program -- list of instructions as returned by compile_program
+        """
+        self.program = program
+        # Counters indexed by instruction and by station id
+        self.instruction_visits = [0] * len(program)
+        self.station_visits = [0] * len(station_names)
+        self.station_time = [0.0] * len(station_names)
+        self.max_jumpstack_depth = 0
+
+    def report(self):
+        """
+        Summarize the profile as a dict
+
+        Returns the total "steps" and "time", the "max_jumpstack_depth",
+        the visited "stations" with their "visits" and handler "time",
+        most time first, and the visited source "lines" with their "text"
+        and "visits", most visits first.
+        """
+        stations = [{"station": station_names[station],
+                     "visits": visits,
+                     "time": self.station_time[station]}
+                    for station, visits in enumerate(self.station_visits) if visits]
+        stations.sort(key=lambda entry: (-entry["time"], entry["station"]))
+
+        # Every instruction comes from a source line of its own
+        lines = [{"line": instruction.position, "text": instruction.text, "visits": visits}
+                 for instruction, visits in zip(self.program, self.instruction_visits) if visits]
+        lines.sort(key=lambda entry: (-entry["visits"], entry["line"]))
+
+        return {"steps": sum(self.instruction_visits),
+                "time": sum(self.station_time),
+                "max_jumpstack_depth": self.max_jumpstack_depth,
+                "stations": stations,
+                "lines": lines}
+
+    def format(self, limit = 20):
+        """
+        Describe the profile as text
+
+        Arguments:
+            limit -- number of stations and lines to list, None for all
+        """
+        report = self.report()
+        steps = report["steps"] or 1
+        total_time = report["time"] or 1
+        lines = ["%d steps, %.3fs in stations, jump stack depth up to %d" % (
+            report["steps"], report["time"], report["max_jumpstack_depth"]), "",
+            "    visits      %      time      %  station"]
+        for entry in report["stations"][:limit]:
+            lines.append("%10d %5.1f%% %8.3fs %5.1f%%  %s" % (
+                entry["visits"], 100.0 * entry["visits"] / steps,
+                entry["time"], 100.0 * entry["time"] / total_time, entry["station"]))
+        lines += ["", "    visits      %  line"]
+        for entry in report["lines"][:limit]:
+            lines.append("%10d %5.1f%%  %5d: %s" % (
+                entry["visits"], 100.0 * entry["visits"] / steps, entry["line"], entry["text"]))
+        return "\n".join(lines)